@@ -10,6 +10,9 @@
 # </license>
 #
 
-from device import Device, DeviceUnreachableException
+from device import Device, DeviceUnreachableException, SIGNAL_KV_UPDATED
 from netscan import SIGNAL_FOUND_DEVICE
+from group import DeviceGroup, GroupTimeoutException
+from registry import DeviceRegistry, device_registry
+from notifier import notify_coalescer
 
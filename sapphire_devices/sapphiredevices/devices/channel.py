@@ -16,6 +16,7 @@ import crcmod
 import sapphiredata
 import socket
 import struct
+import threading
 from Queue import Queue
 
 SERIAL_SOF = 0xfd
@@ -40,13 +41,27 @@ class ChannelUnreachableException(ChannelException):
     pass
 
 class Channel(object):
+
+    # number of requests that can be in flight on the channel at once
+    window = 1
+
     def __init__(self, host, medium='none'):
         self.host = host   
         self.medium = medium
+
+        self._request_lock = threading.Lock()
     
     def __del__(self):
         self.close()
 
+    # write data and read the response as one transaction.
+    # channels that can run concurrent transactions override this.
+    def request(self, data):
+        with self._request_lock:
+            self.write(data)
+
+            return self.read()
+
     def open(self):
         raise NotImplementedError
     
@@ -257,14 +272,16 @@ class UdpxClientPoolChannel(Channel):
     
     POOL_SIZE = 4
 
-    __q = Queue(maxsize=POOL_SIZE)
+    window = POOL_SIZE
 
     def __init__(self, host):
         super(UdpxClientPoolChannel, self).__init__(host, 'pool')
         
         self.timeout = None
         
-        self.q = self.__q
+        # each channel has its own pool, so one device can't use up the
+        # sockets of every other device in the process
+        self.q = Queue(maxsize=self.POOL_SIZE)
         
     def open(self):
         pass
@@ -296,14 +313,17 @@ class UdpxClientPoolChannel(Channel):
         return data
 
     def write(self, data):
+        self.read_data = self.request(data)
+
+    def request(self, data):
         sock = self.getSock()       
         
         try:
             #print "Sent %4d > %s" % (len(data), self.host)
             sock.sendto(data, self.host)
             
-            self.read_data, host = sock.recvfrom()
-            #print "Recv %4d > %s" % (len(self.read_data), host)
+            read_data, host = sock.recvfrom()
+            #print "Recv %4d > %s" % (len(read_data), host)
         
             # check host address
             if host[0] != self.host[0]:
@@ -322,6 +342,7 @@ class UdpxClientPoolChannel(Channel):
         finally:
             self.returnSock(sock)
 
+        return read_data
 
     def settimeout(self, timeout=None):
         self.timeout = timeout
@@ -22,9 +22,15 @@ import sapphiredata
 import sapphiretypes
 import firmware
 import channel
+import kvbatch
+import kvcache
+import filecache
+from registry import device_registry, INDEXED_KEYS
+from notifier import notify_coalescer
 
 import time
 import sys
+import threading
 import datetime
 import types
 from datetime import datetime, timedelta
@@ -33,16 +39,28 @@ from pprint import pprint
 import hashlib
 import binascii
 from UserDict import DictMixin
+from collections import namedtuple
 
 from sapphire.core.store import Store
 
+from pydispatch import dispatcher
+
 
 NTP_EPOCH = datetime(1900, 1, 1)
 
+def ntp_to_datetime(seconds, fraction):
+    return timedelta(seconds=seconds + fraction / float(2**32)) + NTP_EPOCH
+
+# sent with device, key, value and timestamp for each KV notification
+SIGNAL_KV_UPDATED = "signal_kv_updated"
+
 
 FILE_TRANSFER_LEN   = 512
 MAX_KV_DATA_LEN     = 548
 
+# KV batch plans are shared by all devices
+_kv_planner = kvbatch.KVBatchPlanner(MAX_KV_DATA_LEN)
+
 # Key value groups
 KV_GROUP_NULL               = 0
 KV_GROUP_NULL1              = 254
@@ -63,8 +81,18 @@ kv_groups = {
     "kv_group_all":         KV_GROUP_ALL,
 }
 
+kv_group_names = dict((v, k) for k, v in kv_groups.iteritems())
+
 KV_ID_ALL                   = 255
 
+# default freshness of cached KV values, by group.
+# other groups are cached until the device reboots.
+DEFAULT_KV_POLICIES = {
+    KV_GROUP_SYS_CFG:       kvcache.STATIC,
+    KV_GROUP_SYS_INFO:      kvcache.ttl(60.0),
+    KV_GROUP_SYS_STATS:     kvcache.ttl(10.0),
+}
+
 # Key value flags
 KV_FLAGS_READ_ONLY          = 0x0001
 KV_FLAGS_PERSIST            = 0x0004
@@ -123,6 +151,24 @@ class UnrecognizedKeyException(Exception):
     pass
 
 
+# decode flags to strings
+def decode_kv_flags(flags):
+    decoded = list()
+
+    if flags & KV_FLAGS_READ_ONLY:
+        decoded.append("read_only")
+
+    if flags & KV_FLAGS_PERSIST:
+        decoded.append("persist")
+
+    return decoded
+
+
+# immutable description of a single key, shared by every device running
+# the same firmware
+KVKeySchema = namedtuple('KVKeySchema', ['key', 'group', 'id', 'type', 'flags'])
+
+
 class KVKey(object):
     def __init__(self, 
                  device=None, 
@@ -131,24 +177,25 @@ class KVKey(object):
                  flags=None, 
                  type=None, 
                  value=None, 
-                 key=None):
+                 key=None,
+                 schema=None):
 
         self._device = device
-
-        self.group = group
-        self.id = id
-        self.type = type
         self._value = value
-        self.key = key
 
-        # decode flags to strings
-        self.flags = list()
+        if schema is not None:
+            self.group = schema.group
+            self.id = schema.id
+            self.type = schema.type
+            self.key = schema.key
+            self.flags = schema.flags
 
-        if flags & KV_FLAGS_READ_ONLY:
-            self.flags.append("read_only")
-
-        if flags & KV_FLAGS_PERSIST:
-            self.flags.append("persist")
+        else:
+            self.group = group
+            self.id = id
+            self.type = type
+            self.key = key
+            self.flags = decode_kv_flags(flags)
 
     def __str__(self):
         flags = ''
@@ -167,12 +214,9 @@ class KVKey(object):
         return s
 
     def get_value(self):
-        # if value hasn't been initialized, we load from the device
-        if self._value == None:
-            # internal meta data is auto-updated, so we can toss the return value
-            self._device.getKey(self.key)
-
-        return self._value
+        # served from the device's KV cache if fresh, otherwise
+        # loaded from the device
+        return self._device.getCachedKey(self.key)
 
     def set_value(self, value):        
         self._value = value
@@ -182,37 +226,174 @@ class KVKey(object):
 
 
 class KVMeta(DictMixin):
-    def __init__(self):
+    def __init__(self, schema=None, device=None):
         self.kv_items = dict()
 
+        # (group, id) -> key name
+        self._index = dict()
+
+        # key names whose (group, id) was already taken when inserted
+        self._duplicate_ids = set()
+
+        # meta created from a shared schema uses the schema's keys, index
+        # and duplicate set as they are.  the KVKeys holding this device's
+        # values are only created as keys are used.
+        self._schema = schema
+        self._device = device
+
+        if schema is not None:
+            self._index = schema.index
+            self._duplicate_ids = schema.duplicate_ids
+
     def keys(self):
+        if self._schema is not None:
+            return list(self._schema.names)
+
         return self.kv_items.keys()
 
+    def __contains__(self, key):
+        if self._schema is not None:
+            return key in self._schema.by_name
+
+        return key in self.kv_items
+
     def __getitem__(self, key):
-        return self.kv_items[key]
+        try:
+            return self.kv_items[key]
+
+        except KeyError:
+            if self._schema is None:
+                raise
+
+        item = KVKey(device=self._device, schema=self._schema.by_name[key])
+
+        return self.kv_items.setdefault(key, item)
+
+    def _detach(self):
+        # the shared schema can't be changed, take a private copy of it
+        # before adding or removing keys
+        if self._schema is None:
+            return
+
+        for key in self._schema.names:
+            self[key]
+
+        self._index = dict(self._index)
+        self._duplicate_ids = set(self._duplicate_ids)
+        self._schema = None
 
     def __setitem__(self, key, value):
+        self._detach()
+
         if key in self.kv_items:
             # we already have an item here
             raise DuplicateKeyNameException("DuplicateKeyNameException: %s" % (key))
 
         self.kv_items[key] = value
         value.key = key
+
+        if (value.group, value.id) in self._index:
+            self._duplicate_ids.add(key)
+
+        else:
+            self._index[(value.group, value.id)] = key
         
     def __delitem__(self, key):
-        del self.kv_items[key]
+        self._detach()
+
+        value = self.kv_items.pop(key)
+
+        self._duplicate_ids.discard(key)
+
+        if self._index.get((value.group, value.id)) == key:
+            del self._index[(value.group, value.id)]
+
+            # promote a duplicate into the freed slot, if there is one
+            for k in self._duplicate_ids:
+                v = self.kv_items[k]
+
+                if (v.group, v.id) == (value.group, value.id):
+                    self._duplicate_ids.remove(k)
+                    self._index[(v.group, v.id)] = k
+                    break
+
+    # look up key name by group and ID, returns None if not found
+    def lookup(self, group, id):
+        return self._index.get((group, id))
 
     def check(self):
         # check for duplicate IDs
-        for key in self.kv_items:
-            l = len([k for k, v in self.kv_items.iteritems() 
-                        if v.group == self.kv_items[key].group
-                            and v.id == self.kv_items[key].id])
-            
-            if l > 1:
-                raise DuplicateKeyIDException("DuplicateKeyIDException: %s" % (key))
+        if len(self._duplicate_ids) > 0:
+            raise DuplicateKeyIDException("DuplicateKeyIDException: %s" % (', '.join(sorted(self._duplicate_ids))))
         
 
+class KVSchema(object):
+    def __init__(self, kvmeta):
+        # kvmeta is an unpacked KVMetaArray
+        self.keys = tuple([KVKeySchema(kv.param_name, 
+                                       kv.group, 
+                                       kv.id, 
+                                       kv.type, 
+                                       tuple(decode_kv_flags(kv.flags)))
+                            for kv in kvmeta])
+
+        self.names = tuple([k.key for k in self.keys])
+        self.by_name = dict([(k.key, k) for k in self.keys])
+
+        # build the (group, id) index once, every device shares it
+        meta = KVMeta()
+
+        for k in self.keys:
+            meta[k.key] = KVKey(schema=k)
+
+        self.index = meta._index
+        self.duplicate_ids = frozenset(meta._duplicate_ids)
+
+    def create_meta(self, device=None):
+        return KVMeta(schema=self, device=device)
+
+
+# parsed KV schemas by firmware info hash.
+# backed by the on disk kv meta cache.
+_kv_schemas = dict()
+_kv_schemas_lock = threading.Lock()
+_kv_meta_store = None
+
+def get_kv_schema(firmware_hash, fetch):
+    # fetch() is called to read the kvmeta file from a device if the
+    # schema is not in either cache
+    global _kv_meta_store
+
+    with _kv_schemas_lock:
+        try:
+            return _kv_schemas[firmware_hash]
+
+        except KeyError:
+            pass
+
+        if _kv_meta_store is None:
+            _kv_meta_store = Store(db_name="kv_meta_cache.db")
+
+        try:
+            data = binascii.unhexlify(_kv_meta_store[firmware_hash]["kv_meta"])
+
+        except KeyError:
+            data = None
+
+    if data is None:
+        data = fetch()
+
+        with _kv_schemas_lock:
+            _kv_meta_store[firmware_hash] = {"kv_meta": binascii.hexlify(data)} # store data
+
+    # unpack kv meta data
+    schema = KVSchema(sapphiredata.KVMetaArray().unpack(data))
+
+    with _kv_schemas_lock:
+        # another device may have loaded the same schema in the meantime
+        return _kv_schemas.setdefault(firmware_hash, schema)
+
+
 
 class Device(KVObject):
     
@@ -225,6 +406,11 @@ class Device(KVObject):
                  comm_channel=None,
                  gateway=None):
         
+        # held while the KV state is changed, and by the notify coalescer
+        # while it publishes, so a publish doesn't see a half applied
+        # notification.  created first, as set() takes it.
+        self._kv_lock = threading.RLock()
+
         super(Device, self).__init__()
 
         self.host = host
@@ -244,9 +430,21 @@ class Device(KVObject):
         self.object_id = str(self.device_id)
         
         self._keys = KVMeta()
+        self._kv_schema = None
         self._firmware_info_hash = None
+
+        # file ids and firmware file contents
+        self._files = filecache.DeviceFileCache()
+
+        self._kv_cache = kvcache.KVCache(fetch=self.getKV,
+                                         group_of=lambda key: self._keys[key].group,
+                                         online=lambda: self.device_status == 'online',
+                                         group_policies=DEFAULT_KV_POLICIES)
         
         self._channel = comm_channel
+
+        # channels we create are recreated if the host changes
+        self._own_channel = comm_channel is None
         
         # if no channel is specified, create one
         if self._channel is None:
@@ -273,6 +471,31 @@ class Device(KVObject):
 
         return s
     
+    # move an existing device to a new address in place, instead of
+    # creating a new device for it
+    def updateAddress(self, host=None, short_addr=None, gateway=None):
+        if host is not None and host != self.host:
+            self.host = host
+
+            if self._own_channel:
+                self._channel.close()
+                self._channel = channel.createChannel(self.host, port=DeviceCommandProtocol.PORT)
+
+        if short_addr is not None:
+            self.short_addr = short_addr
+
+        if gateway is not None:
+            self._gateway = gateway
+
+        device_registry.update(self)
+
+    def set(self, key, value, timestamp=None):
+        with self._kv_lock:
+            super(Device, self).set(key, value, timestamp=timestamp)
+
+        if key in INDEXED_KEYS:
+            device_registry.update(self)
+
     def update(self, key, value, timestamp=None):
         super(Device, self).update(key, value, timestamp=timestamp)
 
@@ -291,57 +514,80 @@ class Device(KVObject):
         if msg.device_id != self.device_id:
             return
 
+        self.apply_notification(msg.group, 
+                                msg.id, 
+                                msg.data_type, 
+                                msg.data.value,
+                                ntp_to_datetime(msg.timestamp.seconds, msg.timestamp.fraction))
+
+    # apply an already decoded notification.  returns the key name, or
+    # None if the notification was ignored.
+    def apply_notification(self, group, id, data_type, value, timestamp):
         # translate the ID and group to a name
         try:
-            key = self.translateKey(msg.group, msg.id)
+            key = self.translateKey(group, id)
 
         except UnrecognizedKeyException:
             raise
 
         # verify data type
-        if msg.data_type != self._keys[key].type:
-            return
+        if data_type != self._keys[key].type:
+            return None
+
+        with self._kv_lock:
+            # set value
+            self._keys[key]._value = value
+            self._kv_cache.update(key, value)
+            self.set(key, value, timestamp=timestamp)
+
+            # set last received notification timestamp
+            self._last_notification_timestamp = datetime.utcnow()
             
-        # convert NTP timestamp to datetime object
-        ntp_seconds = msg.timestamp.seconds + (msg.timestamp.fraction / (2^32))
-        timestamp = timedelta(seconds=ntp_seconds) + NTP_EPOCH
+            # check if boot_mode
+            if key == 'boot_mode':
+                self.device_status = "offline"
+                self._kv_cache.invalidate()
+                self._files.invalidate()
 
-        # set value
-        value = msg.data.value
-        self._keys[key]._value = value
-        self.set(key, value, timestamp=timestamp)
+            elif self.device_status != "online":
+                self.device_status = "online"
 
-        # set last received notification timestamp
-        self._last_notification_timestamp = datetime.utcnow()
-        
-        # check if boot_mode
-        if key == 'boot_mode':
-            self.device_status = "offline"
+        dispatcher.send(signal=SIGNAL_KV_UPDATED, 
+                        device=self, 
+                        key=key, 
+                        value=value, 
+                        timestamp=timestamp)
 
-        elif self.device_status != "online":
-            self.device_status = "online"
+        # push notifications to KV system, bursts are published once
+        notify_coalescer.add(self, key)
 
-        # push notifications to KV system
-        self.notify()
+        return key
         
-    def scan(self):
+    def scan(self, all_keys=False):
+        # firmware info tells us which key schema the device has
         self.getFirmwareInfo()
+
+        # the schema is only downloaded if we haven't seen this firmware
         self.getKVMeta()
-        try:
+
+        # read the identity keys, or every key.  the identity keys are part
+        # of the full read, so all_keys doesn't cost an extra round trip.
+        if all_keys:
+            self.getAllKV()
+
+        elif "name" in self._keys:
             self.getKV("name", "short_addr")
 
         # backwards compatibility hack
         # TODO make this go away
-        except KeyError:
+        else:
             self.getKV("device_name", "802.15.4_short")
 
         return self
     
     def _sendCommand(self, cmd):
         try:
-            self._channel.write(cmd.pack())
-            
-            data = self._channel.read()
+            data = self._channel.request(cmd.pack())
             
             if self.device_status != 'online':
                 self.device_status = 'online'
@@ -350,6 +596,9 @@ class Device(KVObject):
             if self.device_status == 'online':
                 self.device_status = 'offline'
 
+            # the device may have rebooted behind our back
+            self._files.invalidate()
+
             raise DeviceUnreachableException("Device:%d" % (self.short_addr))
         
                 
@@ -361,6 +610,67 @@ class Device(KVObject):
         
         return response
 
+    # send several commands to the device, keeping up to the channel's
+    # window of them in flight at once.  callback(i, response) is called
+    # as each response arrives.  returns the responses in command order.
+    def _sendCommands(self, cmds, callback=None):
+        responses = [None] * len(cmds)
+
+        window = min(getattr(self._channel, 'window', 1), len(cmds))
+
+        if window <= 1:
+            for i in xrange(len(cmds)):
+                responses[i] = self._sendCommand(cmds[i])
+
+                if callback:
+                    callback(i, responses[i])
+
+            return responses
+
+        pending = range(len(cmds))
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    # stop issuing commands after the first error
+                    if len(pending) == 0 or len(errors) > 0:
+                        return
+
+                    i = pending.pop(0)
+
+                try:
+                    response = self._sendCommand(cmds[i])
+
+                    with lock:
+                        responses[i] = response
+
+                        if callback:
+                            callback(i, response)
+
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+
+                    return
+
+        threads = [threading.Thread(target=worker) for i in xrange(window - 1)]
+
+        for t in threads:
+            t.start()
+
+        # the calling thread works the queue too
+        worker()
+
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        return responses
+
     def get_cli(self):
         return [f.replace(CLI_PREFIX, '', 1) for f in dir(self) 
                 if f.startswith(CLI_PREFIX)
@@ -369,17 +679,13 @@ class Device(KVObject):
     
     # translate the ID and group to a name
     def translateKey(self, group, id):
-        try:
-            if id == KV_ID_ALL:
-                key = [k for k, v in kv_groups.iteritems() 
-                        if v == group].pop()
-            
-            else:
-                key = [k for k, v in self._keys.iteritems() 
-                        if v.group == group 
-                            and v.id == id].pop()
+        if id == KV_ID_ALL:
+            key = kv_group_names.get(group)
 
-        except IndexError:
+        else:
+            key = self._keys.lookup(group, id)
+
+        if key is None:
             # key not found
             raise UnrecognizedKeyException("Device: %d Group: %d ID: %d" % (self.device_id, group, id))
 
@@ -391,79 +697,59 @@ class Device(KVObject):
             # we do not, so lets get one
             self.getFirmwareInfo()
 
-        # check meta cache for a matching hash
-        s = Store(db_name="kv_meta_cache.db")
+        # devices running the same firmware share the same schema
+        schema = get_kv_schema(self._firmware_info_hash, lambda: self.getFile("kvmeta"))
 
-        try:
-            data = binascii.unhexlify(s[self._firmware_info_hash]["kv_meta"])
+        # cached values belong to the old firmware's keys
+        if schema is not self._kv_schema:
+            self._kv_cache.invalidate()
 
-        except KeyError:
-            data = self.getFile("kvmeta")
-            s[self._firmware_info_hash] = {"kv_meta": binascii.hexlify(data)} # store data
+        self._kv_schema = schema
 
-        # unpack kv meta data
-        kvmeta = sapphiredata.KVMetaArray().unpack(data)
-        
         # reset keys
-        self._keys = KVMeta()
-        
-        # load keys into meta data
-        for kv in kvmeta:
-            self._keys[kv.param_name] = KVKey(key=kv.param_name, device=self, group=kv.group, id=kv.id, flags=kv.flags, type=kv.type)
+        self._keys = schema.create_meta(device=self)
     
     def getAllKV(self):
         keys = [key for key in self._keys]
         
-        self.getKV(*keys)
+        return self.getKV(*keys)
 
     def setKey(self, param, value):
         self.setKV(**{param: value})
 
     def setKV(self, **kwargs):
-        params = []
-        
-        keys = {}
-        
-        # iterate over keys and create requests for them
+        # check if any keys are set to read only
         for key in kwargs:
             # filter out keys which are not changing
             #if kwargs[key] == self._keys[key].value:
             #    continue
 
-            # check if key is set to read only
             if 'read_only' in self._keys[key].flags:
                 raise ReadOnlyKeyException(key)
 
-            param = sapphiredata.KVParamField(group=self._keys[key].group,
-                                              id=self._keys[key].id,
-                                              type=self._keys[key].type,
-                                              param_value=kwargs[key])
-            params.append(param)
-            
-            keys[(param.group, param.id)] = key
+        # pack the params into as few batches as will fit within packet
+        # size constraints
+        plan = _kv_planner.plan(kwargs.keys(), self._keys, self._firmware_info_hash)
 
-        # now we have a list of requests, we need to batch them together such
-        # that the params all fit within packet size constraints
-        batches = [sapphiredata.KVParamArray() for param in params]
-        
-        for batch in batches:
-            for param in params:
-                if batch.size() + param.size() < MAX_KV_DATA_LEN:
-                    batch.append(param)
-            
-            for param in batch:
-                params.remove(param)
-        
-        # filter out batches which are empty
-        batches = [batch for batch in batches if len(batch) > 0]
+        cmds = []
+        keys = {}
+
+        for batch_keys in plan:
+            batch = sapphiredata.KVParamArray()
+
+            for key in batch_keys:
+                param = sapphiredata.KVParamField(group=self._keys[key].group,
+                                                  id=self._keys[key].id,
+                                                  type=self._keys[key].type,
+                                                  param_value=kwargs[key])
+                batch.append(param)
+
+                keys[(param.group, param.id)] = key
 
-        # send each batch
-        for batch in batches:
             #cmd = self._protocol.SetKV(params=batch)
-            cmd = self._protocol.SetKV(data=batch.pack())
-            
-            #response = self._sendCommand(cmd)
-            response_msg = self._sendCommand(cmd)
+            cmds.append(self._protocol.SetKV(data=batch.pack()))
+
+        def parse_response(i, response_msg):
             response = sapphiredata.KVStatusArray().unpack(response_msg.data)
         
             # parse responses
@@ -474,6 +760,7 @@ class Device(KVObject):
                 # check status
                 if param.status >= 0:
                     self._keys[key]._value = kwargs[key]
+                    self._kv_cache.update(key, kwargs[key])
 
                     # set internal KVObject attributes
                     self._attrs[key] = kwargs[key]
@@ -481,48 +768,38 @@ class Device(KVObject):
                 else:
                     raise ValueError
 
+        # send the batches concurrently
+        self._sendCommands(cmds, parse_response)
+
     def getKey(self, param):
         return self.getKV(param)[param]
 
     def getKV(self, *args):
-        params = []
-        
+        # pack the requests into as few batches as will fit the responses
+        # within packet size constraints
+        plan = _kv_planner.plan(args, self._keys, self._firmware_info_hash)
+
+        cmds = []
         keys = {}
 
-        # iterate over keys and create requests for them
-        for key in args:
-            param = sapphiredata.KVRequestField(group=self._keys[key].group,
-                                                id=self._keys[key].id,
-                                                type=self._keys[key].type)
+        for batch_keys in plan:
+            batch = sapphiredata.KVRequestArray()
 
-            params.append(param)
-            
-            keys[(param.group, param.id)] = key
+            for key in batch_keys:
+                param = sapphiredata.KVRequestField(group=self._keys[key].group,
+                                                    id=self._keys[key].id,
+                                                    type=self._keys[key].type)
+                batch.append(param)
 
-        # now we have a list of requests, we need to batch them together such
-        # that the responses all fit within packet size constraints
-        batches = [sapphiredata.KVRequestArray() for param in params]
-        
-        for batch in batches:
-            for param in params:
-                if ( batch.paramSize() + param.paramSize() ) < MAX_KV_DATA_LEN:
-                    batch.append(param)
-            
-            for param in batch:
-                params.remove(param)
-            
-        # filter out batches which are empty
-        batches = [batch for batch in batches if len(batch) > 0]
+                keys[(param.group, param.id)] = key
 
-        responses = {}
-        
-        # request each batch
-        for batch in batches:
             #cmd = self._protocol.GetKV(params=batch)
-            cmd = self._protocol.GetKV(data=batch.pack())
+            cmds.append(self._protocol.GetKV(data=batch.pack()))
 
-            #response = self._sendCommand(cmd)
-            response_msg = self._sendCommand(cmd)
+        responses = {}
+
+        # merge each batch into the results as it arrives
+        def parse_response(i, response_msg):
             response = sapphiredata.KVParamArray().unpack(response_msg.data)
 
             # parse responses
@@ -534,14 +811,38 @@ class Device(KVObject):
                 
                 # update internal meta data
                 self._keys[key]._value = param.param_value
+                self._kv_cache.update(key, param.param_value)
 
                 # TODO: hack to avoid clearing the device id
                 if key != "device_id":
                     self.set(key, param.param_value)
+
+        # request the batches concurrently
+        self._sendCommands(cmds, parse_response)
                 
         return responses
 
+    def getCachedKey(self, param):
+        return self.getCachedKV(param)[param]
+
+    # read keys from the KV cache, fetching any that are stale
+    def getCachedKV(self, *args):
+        return self._kv_cache.get(*args)
+
+    # set the cache freshness policy for a key, or a group by name or number
+    def setKVPolicy(self, name, policy):
+        if name in kv_groups:
+            self._kv_cache.set_group_policy(kv_groups[name], policy)
+
+        elif isinstance(name, int):
+            self._kv_cache.set_group_policy(name, policy)
+
+        else:
+            self._kv_cache.set_key_policy(name, policy)
+
     def resetConfig(self):
+        self._kv_cache.invalidate()
+
         return self._sendCommand(self._protocol.ResetCfg())
 
     def setSecurityKey(self, key_id, key):
@@ -556,6 +857,8 @@ class Device(KVObject):
         try:
             response = self._sendCommand(cmd)
             self.device_status = "reboot"
+            self._kv_cache.invalidate()
+            self._files.invalidate()
             
             # device delays 1 second before going offline
             time.sleep(1.0)
@@ -577,15 +880,27 @@ class Device(KVObject):
         return self._rebootCmd(self._protocol.LoadFirmware())
 
     def formatFS(self):
+        self._kv_cache.invalidate()
+        self._files.invalidate()
+
         return self._sendCommand(self._protocol.FormatFS())
     
 
     def get_file_id(self, name):
+        # file IDs are stable until the file is removed or the device
+        # reboots, so we only ask for each one once
+        file_id = self._files.get_id(name)
+
+        if file_id is not None:
+            return file_id
+
         result = self._sendCommand(self._protocol.GetFileID(name=name))
         
         if result.file_id < 0:
             raise IOError("File: %s not found" % (name))
 
+        self._files.set_id(name, result.file_id)
+
         return result.file_id
 
     def create_file(self, name):
@@ -594,6 +909,8 @@ class Device(KVObject):
         if result.file_id < 0:
             raise IOError("File: %s not created" % (name))
 
+        self._files.set_id(name, result.file_id)
+
         return result.file_id
 
     def read_file_data(self, file_id, pos, length):
@@ -607,19 +924,55 @@ class Device(KVObject):
         return result.write_length
 
     def remove_file(self, file_id):
+        self._files.remove_id(file_id)
+
         result = self._sendCommand(self._protocol.RemoveFile(file_id=file_id))
         
         if result.status < 0:
             raise IOError("File: %s not deleted" % (file_id))
 
-    def getFile(self, filename, progress=None):
+    # drop cached file ids and firmware files, for when the device may
+    # have rebooted
+    def invalidateFiles(self):
+        self._files.invalidate()
+
+    # size_hint is the size the file is expected to be, the chunks up to it
+    # are read at once instead of one at a time
+    def getFile(self, filename, progress=None, size_hint=None):
+        # files that only change with the firmware are served from the cache
+        data = self._files.get_content(filename, self._firmware_info_hash)
+
+        if data is not None:
+            if progress:
+                progress(len(data))
+
+            return data
 
         file_id = self.get_file_id(filename)
         
         data = ""
         pos = 0
+        done = False
+
+        if size_hint:
+            positions = range(0, size_hint + 1, FILE_TRANSFER_LEN)
+
+            results = self._sendCommands([self._protocol.ReadFileData(file_id=file_id, 
+                                                                      position=p, 
+                                                                      length=FILE_TRANSFER_LEN)
+                                            for p in positions])
+
+            for result in results:
+                data += result.data
 
-        while True:
+                if len(result.data) < FILE_TRANSFER_LEN:
+                    done = True
+                    break
+
+            # if the file is larger than expected, read the rest
+            pos = len(data)
+
+        while not done:
             if progress:
                 progress(pos)
 
@@ -635,8 +988,76 @@ class Device(KVObject):
         if progress:
             progress(len(data))
 
+        self._files.put_content(filename, data, self._firmware_info_hash)
+
         return data
 
+    # read several files at once.  file ID lookups and reads are pipelined
+    # across the channel window, one chunk of each file in flight per
+    # round.  returns a dict of name -> data.  with missing_ok, files
+    # which don't exist are left out of the result instead of raising.
+    def getFiles(self, *filenames, **kwargs):
+        missing_ok = kwargs.get('missing_ok', False)
+
+        files = dict()
+        pending = list()
+
+        for name in filenames:
+            data = self._files.get_content(name, self._firmware_info_hash)
+
+            if data is not None:
+                files[name] = data
+
+            else:
+                pending.append(name)
+
+        # look up the IDs we don't already know
+        lookups = [name for name in pending if self._files.get_id(name) is None]
+        missing = list()
+
+        def parse_file_id(i, result):
+            if result.file_id < 0:
+                missing.append(lookups[i])
+
+            else:
+                self._files.set_id(lookups[i], result.file_id)
+
+        self._sendCommands([self._protocol.GetFileID(name=name) for name in lookups], parse_file_id)
+
+        if len(missing) > 0 and not missing_ok:
+            raise IOError("File: %s not found" % (missing[0]))
+
+        # name -> read position
+        positions = dict([(name, 0) for name in pending if name not in missing])
+
+        for name in positions:
+            files[name] = ""
+
+        while len(positions) > 0:
+            reads = positions.items()
+
+            def parse_data(i, result):
+                name, pos = reads[i]
+
+                files[name] += result.data
+
+                if len(result.data) < FILE_TRANSFER_LEN:
+                    del positions[name]
+
+                    self._files.put_content(name, files[name], self._firmware_info_hash)
+
+                else:
+                    positions[name] += FILE_TRANSFER_LEN
+
+            cmds = [self._protocol.ReadFileData(file_id=self.get_file_id(name), 
+                                                position=pos, 
+                                                length=FILE_TRANSFER_LEN)
+                        for name, pos in reads]
+
+            self._sendCommands(cmds, parse_data)
+
+        return files
+
     def putFile(self, filename, data, progress=None):
         
         # get file id
@@ -647,6 +1068,8 @@ class Device(KVObject):
         except IOError:
             file_id = self.create_file(filename)
 
+        self._files.discard(filename)
+
         pos = 0
 
         while pos < len(data):
@@ -672,25 +1095,31 @@ class Device(KVObject):
 
         return fileinfo
     
-    def loadFirmware(self, firmware_id=None, progress=None):
-        if firmware_id == None:
-            fw_info = self.getFirmwareInfo()
-            fw_file = firmware.get_firmware(fw_info.firmware_id)
-            
+    def loadFirmware(self, firmware_id=None, progress=None, data=None):
+        # data can be passed in by callers loading the same image onto
+        # many devices, so it is only read once
+        if data is not None:
+            firmware_data = data
+
         else:
-            fw_file = firmware.get_firmware(firmware_id)
-        
-        if fw_file is None:
-            raise IOError("Firmware image not found")
-        
+            if firmware_id == None:
+                fw_info = self.getFirmwareInfo()
+                fw_file = firmware.get_firmware(fw_info.firmware_id)
+
+            else:
+                fw_file = firmware.get_firmware(firmware_id)
+
+            if fw_file is None:
+                raise IOError("Firmware image not found")
+
+            # read firmware data
+            f = open(fw_file, 'rb')
+            firmware_data = f.read()
+            f.close()
+
         # delete old firmware
         file_id = self.get_file_id("firmware.bin")
         self.remove_file(file_id)
-        
-        # read firmware data
-        f = open(fw_file, 'rb')
-        firmware_data = f.read()
-        f.close()
 
         # load firmware image
         self.putFile("firmware.bin", firmware_data, progress=progress)
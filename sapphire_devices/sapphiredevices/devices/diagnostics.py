@@ -0,0 +1,154 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Diagnostics
+
+Collects a health snapshot of a device in one pass: the system tables
+(flash GC, threads, routes, neighbors, DNS cache) and the sys_info and
+sys_stats KV groups.  The file reads are pipelined across the device's
+channel window, and a fleet is collected concurrently through a
+DeviceGroup.
+
+Snapshots can be exported as JSON, or as CSV with one row per device and
+one column per scalar value.
+"""
+
+import json
+import csv
+from datetime import datetime
+
+from fields import ArrayField, Uint32Field
+import sapphiredata
+from device import KV_GROUP_SYS_INFO, KV_GROUP_SYS_STATS
+from group import DeviceGroup
+
+
+# system table files and how to unpack them
+DIAGNOSTIC_FILES = {
+    "gc_data":      lambda: ArrayField(field=Uint32Field),
+    "threadinfo":   sapphiredata.ThreadInfoArray,
+    "routes":       sapphiredata.RouteArray,
+    "neighbors":    sapphiredata.NeighborArray,
+    "dns_cache":    sapphiredata.DnsCacheArray,
+}
+
+DIAGNOSTIC_KV_GROUPS = [KV_GROUP_SYS_INFO, KV_GROUP_SYS_STATS]
+
+
+def collect(device):
+    # the key schema is needed to find the KV groups
+    if len(device._keys) == 0:
+        device.getKVMeta()
+
+    snapshot = {"device_id":        device.device_id,
+                "name":             device.name,
+                "short_addr":       device.short_addr,
+                "host":             device.host,
+                "firmware_name":    device.firmware_name,
+                "firmware_version": device.firmware_version,
+                "os_version":       device.os_version,
+                "timestamp":        datetime.utcnow().isoformat()}
+
+    keys = [k for k in device._keys if device._keys[k].group in DIAGNOSTIC_KV_GROUPS]
+
+    snapshot["kv"] = device.getKV(*keys)
+
+    files = device.getFiles(*DIAGNOSTIC_FILES.keys(), missing_ok=True)
+
+    for name, data in files.iteritems():
+        snapshot[name] = DIAGNOSTIC_FILES[name]().unpack(data).toBasic()
+
+    return snapshot
+
+
+def collect_fleet(devices, **kwargs):
+    # kwargs are passed to DeviceGroup.
+    # returns dicts of device_id -> snapshot and device_id -> error string.
+    snapshots = dict()
+    errors = dict()
+
+    # collect reads keys and files across the channel window
+    kwargs.setdefault('pipelined', True)
+
+    for device, snapshot, error in DeviceGroup(devices, **kwargs).imap(collect):
+        if error is not None:
+            errors[device.device_id] = str(error)
+
+        else:
+            snapshots[device.device_id] = snapshot
+
+    return snapshots, errors
+
+
+def summarize(snapshot):
+    # flatten a snapshot into a dict of scalar columns
+    row = dict()
+
+    for k, v in snapshot.iteritems():
+        if k == "kv":
+            for key, value in v.iteritems():
+                row["kv." + key] = value
+
+        elif isinstance(v, list):
+            row[k + ".count"] = len(v)
+
+        else:
+            row[k] = v
+
+    if "gc_data" in snapshot and len(snapshot["gc_data"]) > 0:
+        row["gc_data.erases"] = sum(snapshot["gc_data"])
+        row["gc_data.most"] = max(snapshot["gc_data"])
+        row["gc_data.least"] = min(snapshot["gc_data"])
+
+    if "dns_cache" in snapshot:
+        row["dns_cache.count"] = len([d for d in snapshot["dns_cache"] if d["status"] != 0])
+
+    return row
+
+
+def export_json(snapshots, f):
+    json.dump(snapshots.values(), f, indent=2, sort_keys=True)
+
+
+def export_csv(snapshots, f):
+    rows = [summarize(s) for s in snapshots.itervalues()]
+
+    columns = set()
+
+    for row in rows:
+        columns.update(row.keys())
+
+    # identity columns first
+    leading = ["device_id", "name", "short_addr", "host", "timestamp"]
+    columns = leading + sorted(columns - set(leading))
+
+    writer = csv.DictWriter(f, columns)
+    writer.writerow(dict(zip(columns, columns)))
+
+    for row in rows:
+        writer.writerow(row)
+
+
+def export(snapshots, filename):
+    # format is chosen by file extension
+    f = open(filename, 'wb')
+
+    try:
+        if filename.endswith(".csv"):
+            export_csv(snapshots, f)
+
+        else:
+            export_json(snapshots, f)
+
+    finally:
+        f.close()
+
@@ -15,6 +15,7 @@ import struct
 import uuid
 import json
 import binascii
+import copy
 
 from string import printable
 from collections import OrderedDict
@@ -46,6 +47,15 @@ class Field(object):
 
     value = property(get_value, set_value)
 
+    # a new instance of this field with the same name and value, much
+    # cheaper than a deepcopy.  values are immutable, only containers
+    # need their inner fields cloned.
+    def clone(self):
+        c = object.__new__(type(self))
+        c.__dict__.update(self.__dict__)
+
+        return c
+
     def size(self):
         return 0
 
@@ -538,6 +548,24 @@ class StructField(Field):
     def __getattr__(self, name):
         if name in self.fields:
             return self.fields[name].value
+
+    def __deepcopy__(self, memo):
+        # __getattr__ gets in the way of the default deepcopy
+        c = object.__new__(type(self))
+        memo[id(self)] = c
+
+        c.__dict__.update(copy.deepcopy(self.__dict__, memo))
+
+        return c
+
+    def clone(self):
+        c = object.__new__(type(self))
+        c.__dict__.update(self.__dict__)
+
+        c.__dict__["fields"] = OrderedDict([(k, f.clone()) for k, f in self.fields.iteritems()])
+        c.__dict__["_value"] = c
+
+        return c
     
     def __setattr__(self, name, value):
         if "fields" in self.__dict__ and name in self.__dict__["fields"]:
@@ -582,6 +610,12 @@ class ArrayField(Field):
         
         self.length = len(self.fields)
 
+    def clone(self):
+        c = super(ArrayField, self).clone()
+        c.fields = [f.clone() for f in self.fields]
+
+        return c
+
     def split_array(self, array, chunksize):
         
         n_chunks = len(array) / chunksize
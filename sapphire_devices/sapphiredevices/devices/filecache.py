@@ -0,0 +1,138 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""File cache
+
+Each device keeps a cache of file name -> file ID, and of the contents of
+system files which only change with a firmware update.  Both are
+invalidated when the device reboots or formats its file system.
+
+Firmware files are also kept in a content addressed store shared by all
+devices, indexed by firmware hash, so devices running the same firmware
+only download them once.
+"""
+
+import threading
+import hashlib
+
+
+# files whose contents only change with a firmware update
+FIRMWARE_FILES = set(['fwinfo', 'kvmeta'])
+
+# fwinfo is what the firmware hash is computed from, so it can only be
+# cached per device, not looked up by firmware hash
+FIRMWARE_INFO_FILE = 'fwinfo'
+
+
+class FirmwareFileStore(object):
+    def __init__(self):
+        # (firmware hash, file name) -> digest
+        self._index = dict()
+
+        # digest -> data
+        self._blobs = dict()
+
+        self._lock = threading.Lock()
+
+    def get(self, firmware_hash, name):
+        with self._lock:
+            try:
+                return self._blobs[self._index[(firmware_hash, name)]]
+
+            except KeyError:
+                return None
+
+    def put(self, firmware_hash, name, data):
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            self._blobs.setdefault(digest, data)
+            self._index[(firmware_hash, name)] = digest
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self._blobs.clear()
+
+
+firmware_files = FirmwareFileStore()
+
+
+class DeviceFileCache(object):
+    def __init__(self, store=firmware_files):
+        self._store = store
+
+        # file name -> file id
+        self._file_ids = dict()
+
+        # file name -> data, for firmware files
+        self._contents = dict()
+
+        self._lock = threading.Lock()
+
+    def get_id(self, name):
+        with self._lock:
+            return self._file_ids.get(name)
+
+    def set_id(self, name, file_id):
+        with self._lock:
+            self._file_ids[name] = file_id
+
+    def remove_id(self, file_id):
+        # file IDs can be reused once the file is gone
+        with self._lock:
+            for name in [k for k, v in self._file_ids.iteritems() if v == file_id]:
+                del self._file_ids[name]
+                self._contents.pop(name, None)
+
+    def get_content(self, name, firmware_hash=None):
+        if name not in FIRMWARE_FILES:
+            return None
+
+        with self._lock:
+            try:
+                return self._contents[name]
+
+            except KeyError:
+                pass
+
+        if firmware_hash is None or name == FIRMWARE_INFO_FILE:
+            return None
+
+        data = self._store.get(firmware_hash, name)
+
+        if data is not None:
+            with self._lock:
+                self._contents[name] = data
+
+        return data
+
+    def put_content(self, name, data, firmware_hash=None):
+        if name not in FIRMWARE_FILES:
+            return
+
+        with self._lock:
+            self._contents[name] = data
+
+        if firmware_hash is not None and name != FIRMWARE_INFO_FILE:
+            self._store.put(firmware_hash, name, data)
+
+    def discard(self, name):
+        # forget about a file that has been written to
+        with self._lock:
+            self._contents.pop(name, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._file_ids.clear()
+            self._contents.clear()
+
@@ -11,6 +11,7 @@
 #
 
 import os
+import uuid
 
 from sapphiredevices.buildtools import core
 
@@ -22,13 +23,21 @@ class FirmwareNotFoundException(Exception):
         return repr(self.value)
 
 
-def get_firmware(fwid):
+def _get_builder(fwid):
+    # fwid is a firmware ID, in any form uuid accepts, or a project name
     try:
-        builder = core.get_project_builder(fwid=fwid)    
+        return core.get_project_builder(fwid=str(uuid.UUID(fwid)))
+
+    except (ValueError, core.ProjectNotFoundException):
+        return core.get_project_builder(proj_name=fwid)
+
+
+def get_firmware(fwid):
+    return os.path.join(_get_builder(fwid).target_dir, "firmware.bin")
 
-    except core.ProjectNotFoundException:
-        builder = core.get_project_builder(proj_name=fwid)
 
-    return os.path.join(builder.target_dir, "firmware.bin")
+def get_firmware_id(fwid):
+    # the firmware ID as devices report it
+    return str(uuid.UUID(_get_builder(fwid).fwid))
 
     
\ No newline at end of file
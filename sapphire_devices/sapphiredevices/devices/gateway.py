@@ -20,14 +20,18 @@ import udpx
 import datetime
 import logging
 import time
+import hashlib
+import threading
 
-from sapphire.core import KVObjectsManager
+from pydispatch import dispatcher
+
+from registry import device_registry
+from netclock import NetworkClock, TimeNotSynchronizedException
 
 
 FWID = "e966b682-ce7c-4c80-8373-2f1ee344e39d"
 
 NTP_EPOCH = datetime.datetime(1900, 1, 1)
-NETWORK_SYNC_VALID_INTERVAL = datetime.timedelta(minutes=5)
 
 GATEWAY_SERVICES_PORT           = 25002
 GATEWAY_SERVICES_UDPX_PORT      = 25003
@@ -36,7 +40,22 @@ GATEWAY_NET_TIME_FLAGS_WCOM_NETWORK_SYNC     = 0x01
 GATEWAY_NET_TIME_FLAGS_NTP_SYNC              = 0x02
 GATEWAY_NET_TIME_FLAGS_VALID                 = 0x04
 
+SIGNAL_FOUND_GATEWAY = "signal_found_gateway"
+
+# gateway discovery polls this often, and forgets gateways which haven't
+# answered for the expire time
+DISCOVERY_POLL_INTERVAL         = 5.0
+DISCOVERY_EXPIRE                = 30.0
+
 
+def _gatewayFromToken(msg, host):
+    # check if gateway is already known
+    obj = device_registry.get(msg.device_id)
+
+    if obj is None:
+        obj = Gateway(host=host[0], short_addr=msg.short_addr, device_id=msg.device_id)
+
+    return obj
 
 def getGateways(timeout=1.0):
     # create socket
@@ -61,16 +80,7 @@ def getGateways(timeout=1.0):
             try:
                 msg = GatewayServicesProtocol().unpack(data)
                 
-                # check if gateway is already in the object manager
-                obj_query = KVObjectsManager.query(device_id=msg.device_id)
-
-                if len(obj_query) > 0:
-                    obj = obj_query[0]
-
-                else:
-                    obj = Gateway(host=host[0], short_addr=msg.short_addr, device_id=msg.device_id)
-
-                gateways.append(obj)
+                gateways.append(_gatewayFromToken(msg, host))
             
             except:
                 raise
@@ -82,8 +92,141 @@ def getGateways(timeout=1.0):
 
     return gateways
 
-class TimeNotSynchronizedException(Exception):
-    pass
+
+class GatewayDiscovery(threading.Thread):
+    # keeps the broadcast socket open and polls for gateways on a
+    # schedule.  replies are taken whenever they arrive, so the current
+    # gateways are available at any time without waiting on a poll.
+    def __init__(self, 
+                 poll_interval=DISCOVERY_POLL_INTERVAL, 
+                 expire=DISCOVERY_EXPIRE,
+                 reply_timeout=1.0):
+
+        super(GatewayDiscovery, self).__init__()
+
+        self.poll_interval = poll_interval
+        self.expire = expire
+
+        # device_id -> [gateway, time last seen]
+        self._gateways = dict()
+        self._lock = threading.Lock()
+
+        # set once the first poll has had time to be answered
+        self.ready = threading.Event()
+        self._reply_timeout = reply_timeout
+
+        self.polls = 0
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._sock.settimeout(0.5)
+
+        self._stop_event = threading.Event()
+
+        self.start()
+
+    def _poll(self):
+        msg = GatewayServicesProtocol().PollGateway(short_addr = 0)
+
+        try:
+            self._sock.sendto(msg.pack(), ('255.255.255.255', GATEWAY_SERVICES_PORT))
+
+        except socket.error as e:
+            logging.info("GatewayDiscovery: poll failed: %s" % (e))
+
+        self.polls += 1
+
+    def _reply(self, data, host):
+        try:
+            msg = GatewayServicesProtocol().unpack(data)
+
+        except Exception as e:
+            logging.debug("GatewayDiscovery: bad reply from %s: %s" % (host[0], e))
+            return
+
+        if not isinstance(msg, GatewayServicesProtocol.GatewayToken):
+            return
+
+        with self._lock:
+            try:
+                entry = self._gateways[msg.device_id]
+
+            except KeyError:
+                entry = None
+
+        if entry is not None:
+            obj = entry[0]
+
+            # gateway moved
+            if obj.host != host[0] or obj.short_addr != msg.short_addr:
+                obj.updateAddress(host=host[0], short_addr=msg.short_addr)
+
+            entry[1] = time.time()
+
+            return
+
+        obj = _gatewayFromToken(msg, host)
+
+        with self._lock:
+            self._gateways[msg.device_id] = [obj, time.time()]
+
+        logging.info("GatewayDiscovery: found gateway %s at %s" % (msg.device_id, host[0]))
+
+        dispatcher.send(signal=SIGNAL_FOUND_GATEWAY, sender=self, gateway=obj)
+
+    def gateways(self):
+        # gateways heard from within the expire time
+        now = time.time()
+
+        with self._lock:
+            return [g for g, last_seen in self._gateways.itervalues() if now - last_seen < self.expire]
+
+    def last_seen(self):
+        # device_id -> seconds since each gateway last answered
+        now = time.time()
+
+        with self._lock:
+            return dict([(k, now - v[1]) for k, v in self._gateways.iteritems()])
+
+    def run(self):
+        logging.info("GatewayDiscovery started")
+
+        start = time.time()
+        next_poll = start
+
+        while not self._stop_event.is_set():
+            now = time.time()
+
+            if now >= next_poll:
+                self._poll()
+
+                next_poll = now + self.poll_interval
+
+            if not self.ready.is_set() and now >= start + self._reply_timeout:
+                self.ready.set()
+
+            try:
+                data, host = self._sock.recvfrom(4096)
+
+            except socket.timeout:
+                continue
+
+            except socket.error as e:
+                if not self._stop_event.is_set():
+                    logging.info("GatewayDiscovery: receive failed: %s" % (e))
+                    self._stop_event.wait(1.0)
+
+                continue
+
+            self._reply(data, host)
+
+        self._sock.close()
+
+        logging.info("GatewayDiscovery stopped")
+
+    def stop(self):
+        logging.info("GatewayDiscovery shutting down")
+        self._stop_event.set()
 
 class Gateway(Device):
    
@@ -93,9 +236,25 @@ class Gateway(Device):
         self._wcom_network_time_base = None
         self._ntp_time_base = None
 
+        # network time conversion, synced in the background
+        self.clock = NetworkClock(refresh=self.getNetworkTime)
+
         # gateway is its own gateway
         self._gateway = self
 
+        # last device DB seen, so unchanged scans can be skipped
+        self._devicedb_hash = None
+        self._devicedb_size = None
+
+        # device_id -> ((short_addr, ip), device)
+        self._devicedb = dict()
+
+        # number of devices added, changed or removed by the last getDevices()
+        self.devicedb_changes = 0
+
+        # held while the device DB is read and diffed
+        self._devicedb_lock = threading.Lock()
+
     def get_device_db(self):
         data = self.getFile("devicedb")
 
@@ -104,27 +263,76 @@ class Gateway(Device):
 
         return db
 
-    def getDevices(self):
+    def getDevices(self, blocking=True):
+        # a call left running by a timed out scan may still be reading the
+        # DB.  without blocking, the devices from the last read are
+        # returned instead of waiting for it.
+        if not self._devicedb_lock.acquire(blocking):
+            logging.debug("Gateway: %s still reading device DB" % (self.device_id))
+
+            return [d for entry, d in self._devicedb.values()]
+
         try:
-            data = self.getFile("devicedb")
-         
-        except Exception as e:
-            print e
-            return list()
+            return self._readDevices()
+
+        finally:
+            self._devicedb_lock.release()
+
+    def _readDevices(self):
+        # the DB is read in one round trip if its size hasn't changed
+        data = self.getFile("devicedb", size_hint=self._devicedb_size)
+
+        self._devicedb_size = len(data)
+
+        digest = hashlib.sha1(data).digest()
+
+        # nothing changed, hand back the same devices
+        if digest == self._devicedb_hash:
+            self.devicedb_changes = 0
+
+            return [d for entry, d in self._devicedb.itervalues()]
+
+        self._devicedb_hash = digest
 
         devicedb = DeviceDBArray().unpack(data)
         
-        devices = list()
+        old_db = self._devicedb
+        new_db = dict()
 
         for d in devicedb:
-            new_dev = device.createDevice(host=d.ip,
-                                          device_id=d.device_id,
-                                          short_addr=d.short_addr,
-                                          gateway=self)
+            entry = (d.short_addr, d.ip)
+
+            # only new or changed entries need a new device
+            try:
+                old_entry, new_dev = old_db[d.device_id]
+
+                if old_entry == entry:
+                    new_db[d.device_id] = (entry, new_dev)
+                    continue
+
+            except KeyError:
+                pass
+
+            # a device we already know, from an earlier scan or another
+            # gateway, is moved to its new address
+            new_dev = device_registry.get(d.device_id)
+
+            if new_dev is not None:
+                new_dev.updateAddress(host=d.ip, short_addr=d.short_addr, gateway=self)
+
+            else:
+                new_dev = device.createDevice(host=d.ip,
+                                              device_id=d.device_id,
+                                              short_addr=d.short_addr,
+                                              gateway=self)
             
-            devices.append(new_dev)
+            new_db[d.device_id] = (entry, new_dev)
+
+        self.devicedb_changes = len([k for k in new_db if k not in old_db or old_db[k][0] != new_db[k][0]]) + \
+                                len([k for k in old_db if k not in new_db])
+        self._devicedb = new_db
 
-        return devices
+        return [d for entry, d in new_db.itervalues()]
     
     def getNetworkTime(self):
         cmd = GatewayServicesProtocol().GetNetworkTime()
@@ -151,6 +359,8 @@ class Gateway(Device):
                 
                 # assign ntp base
                 self._ntp_time_base = ntp_now
+
+                self.clock.add_sync_point(msg.wcom_network_time, ntp_seconds)
                 
                 logging.debug("Time resync network base:%s ntp base:%s" % (self._wcom_network_time_base, self._ntp_time_base))
 
@@ -159,6 +369,8 @@ class Gateway(Device):
                 self._wcom_network_time_base = None
                 self._ntp_time_base = None
 
+                self.clock.reset()
+
         except socket.timeout:
             raise DeviceUnreachableException
 
@@ -171,38 +383,14 @@ class Gateway(Device):
         # return both timestamps
         return self._wcom_network_time_base, self._ntp_time_base
     
+    # network times are converted with the clock model, which never
+    # waits on the gateway.  raises TimeNotSynchronizedException until
+    # the first sync completes.
     def convertNetworkTime(self, network_time):
-        try:
-            # check if synchronized
-            if self._ntp_time_base == None or self._wcom_network_time_base == None:
-                # resync with gateway
-                self.getNetworkTime()
+        return self.clock.convert(network_time)
 
-            # get current time
-            now = datetime.datetime.utcnow()
-            
-            # check if synchronization is out of date
-            if now > self._ntp_time_base + NETWORK_SYNC_VALID_INTERVAL:
-                # resync with gateway
-                self.getNetworkTime()
-            
-            # get elapsed microseconds of network time
-            elapsed_network_time = network_time - self._wcom_network_time_base
-
-            # check if elapsed network time is valid
-            if abs(elapsed_network_time) >= ((2**32) / 2):
-                # resync with gateway
-                self.getNetworkTime()
-                elapsed_network_time = network_time - self._wcom_network_time_base
-
-            # convert net time from microseconds to seconds
-            elapsed_network_time = float(elapsed_network_time) / 1000000.0
-            
-            # add elapsed time to ntp base and return
-            return self._ntp_time_base + datetime.timedelta(seconds=elapsed_network_time)
-        
-        except DeviceUnreachableException:
-            raise TimeNotSynchronizedException
+    def convertNetworkTimes(self, network_times):
+        return self.clock.convert_many(network_times)
 
     def get_bridge_info(self):
         data = self.getFile("bridge")
@@ -0,0 +1,242 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Device group
+
+Runs a Device method (or any function of a device) on a set of devices
+concurrently, with a bounded number of worker threads and a cap on the
+number of calls in flight behind each gateway.
+
+Unless per_gateway is given, the number of calls behind a gateway is
+sized so that about GATEWAY_REQUESTS requests are in flight through it.
+Most calls send one request at a time.  Calls which pipeline requests
+across the device's channel window (getKV, getFiles and the like) should
+pass pipelined=True, so the limit is divided by the window.
+
+    group = DeviceGroup(devices)
+
+    results, errors = group.call('getKV', 'name', 'short_addr')
+
+    for device, result, error in group.imap('echo', 'hello'):
+        ...
+
+With a timeout, calls still running when it expires are reported with a
+GroupTimeoutException and left to finish in the background.
+"""
+
+import threading
+import time
+import traceback
+from Queue import Queue, Empty
+
+
+DEFAULT_MAX_WORKERS         = 16
+
+# requests in flight behind one gateway
+GATEWAY_REQUESTS            = 16
+
+
+class GroupTimeoutException(Exception):
+    pass
+
+
+def gateway_key(device):
+    # devices are grouped by the gateway they are reached through.
+    # devices without a gateway (serial, direct IP) get their own group.
+    if device._gateway is not None:
+        return device._gateway.device_id
+
+    return device.host
+
+
+def interleave(devices):
+    # order devices round robin across gateways, so idle workers aren't
+    # all stuck waiting on the same gateway
+    groups = dict()
+    order = list()
+
+    for device in devices:
+        key = gateway_key(device)
+
+        if key not in groups:
+            groups[key] = list()
+            order.append(key)
+
+        groups[key].append(device)
+
+    interleaved = list()
+
+    while len(interleaved) < len(devices):
+        for key in order:
+            if len(groups[key]) > 0:
+                interleaved.append(groups[key].pop(0))
+
+    return interleaved
+
+
+class GroupResult(object):
+    def __init__(self, device, result=None, error=None, elapsed=0.0, traceback=None):
+        self.device = device
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+        # formatted traceback of the error, if any
+        self.traceback = traceback
+
+    # allows: for device, result, error in group.imap(...)
+    def __iter__(self):
+        return iter((self.device, self.result, self.error))
+
+
+class DeviceGroup(object):
+    def __init__(self,
+                 devices=[],
+                 max_workers=DEFAULT_MAX_WORKERS,
+                 per_gateway=None,
+                 pipelined=False,
+                 timeout=None):
+
+        self.devices = list(devices)
+        self.max_workers = max_workers
+        self.per_gateway = per_gateway
+        self.pipelined = pipelined
+
+        # seconds to wait for all calls to complete, None waits forever
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._gateway_limits = dict()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def _gateway_limit(self, device):
+        key = gateway_key(device)
+
+        with self._lock:
+            if key not in self._gateway_limits:
+                limit = self.per_gateway
+
+                if limit is None:
+                    window = 1
+
+                    if self.pipelined:
+                        window = getattr(device._channel, 'window', 1)
+
+                    limit = max(1, GATEWAY_REQUESTS // window)
+
+                self._gateway_limits[key] = threading.BoundedSemaphore(limit)
+
+            return self._gateway_limits[key]
+
+    def _run(self, device, method, args, kwargs):
+        if callable(method):
+            func = lambda: method(device, *args, **kwargs)
+
+        else:
+            func = lambda: getattr(device, method)(*args, **kwargs)
+
+        with self._gateway_limit(device):
+            start = time.time()
+
+            try:
+                return GroupResult(device, result=func(), elapsed=time.time() - start)
+
+            except Exception as e:
+                return GroupResult(device, 
+                                   error=e, 
+                                   elapsed=time.time() - start, 
+                                   traceback=traceback.format_exc())
+
+    def imap(self, method, *args, **kwargs):
+        # method is the name of a Device method, or a function taking the
+        # device as its first argument.  yields GroupResults as each
+        # device completes.
+        todo = Queue()
+        done = Queue()
+
+        for device in interleave(self.devices):
+            todo.put(device)
+
+        def worker():
+            while True:
+                try:
+                    device = todo.get_nowait()
+
+                except Empty:
+                    return
+
+                done.put(self._run(device, method, args, kwargs))
+
+        n_workers = min(self.max_workers, len(self.devices))
+
+        for i in xrange(n_workers):
+            t = threading.Thread(target=worker)
+
+            # don't hold up exit for calls we stopped waiting on
+            t.daemon = self.timeout is not None
+            t.start()
+
+        pending = list(self.devices)
+
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+
+        while len(pending) > 0:
+            try:
+                if self.timeout is None:
+                    r = done.get()
+
+                else:
+                    r = done.get(timeout=max(deadline - time.time(), 0))
+
+            except Empty:
+                break
+
+            pending.remove(r.device)
+
+            yield r
+
+        if len(pending) == 0:
+            return
+
+        # timed out, calls not yet started are skipped
+        while True:
+            try:
+                todo.get_nowait()
+
+            except Empty:
+                break
+
+        for device in pending:
+            yield GroupResult(device, 
+                              error=GroupTimeoutException("No response in %.1f seconds" % (self.timeout)),
+                              elapsed=self.timeout)
+
+    def call(self, method, *args, **kwargs):
+        # returns dicts of device -> result and device -> exception
+        results = dict()
+        errors = dict()
+
+        for r in self.imap(method, *args, **kwargs):
+            if r.error is not None:
+                errors[r.device] = r.error
+
+            else:
+                results[r.device] = r.result
+
+        return results, errors
+
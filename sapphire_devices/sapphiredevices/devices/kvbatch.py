@@ -0,0 +1,113 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""KV batch planner
+
+Packs KV requests into the fewest GetKV/SetKV datagrams.  KV params have a
+fixed size per type, so the same plan works for both directions: a GetKV
+batch is bounded by the size of the params in the response, and a SetKV
+batch by the size of the params in the request.
+
+Plans are cached by firmware hash and key set, so devices running the same
+firmware share them and repeated getAllKV() calls skip planning.
+"""
+
+import threading
+
+import sapphiredata
+
+
+PLAN_CACHE_SIZE = 1024
+
+
+_param_sizes = dict()
+
+def param_size(type):
+    # packed size of a KV param of the given type
+    try:
+        return _param_sizes[type]
+
+    except KeyError:
+        size = sapphiredata.KVParamField(type=type).size()
+        _param_sizes[type] = size
+
+        return size
+
+
+def pack(items, max_len):
+    # first fit decreasing bin packing.
+    # items is a list of (key, size), returns a list of lists of keys.
+    # a batch is full when its total size would reach max_len.
+    bins = list()
+
+    for key, size in sorted(items, key=lambda item: item[1], reverse=True):
+        for b in bins:
+            if b[0] + size < max_len:
+                b[0] += size
+                b[1].append(key)
+                break
+
+        else:
+            bins.append([size, [key]])
+
+    return [b[1] for b in bins]
+
+
+class KVBatchPlanner(object):
+    def __init__(self, max_len, cache_size=PLAN_CACHE_SIZE):
+        self.max_len = max_len
+        self.cache_size = cache_size
+
+        self._plans = dict()
+        self._lock = threading.Lock()
+
+    def plan(self, keys, kvmeta, firmware_hash=None):
+        # without a firmware hash the key set can't be identified, so the
+        # plan is computed but not cached
+        cache_key = None
+
+        if firmware_hash is not None:
+            cache_key = (firmware_hash, frozenset(keys))
+
+            with self._lock:
+                try:
+                    return self._plans[cache_key]
+
+                except KeyError:
+                    pass
+
+        # remove duplicate keys, preserving order
+        unique_keys = list()
+        seen = set()
+
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                unique_keys.append(key)
+
+        items = [(key, param_size(kvmeta[key].type)) for key in unique_keys]
+
+        plan = tuple([tuple(batch) for batch in pack(items, self.max_len)])
+
+        if cache_key is not None:
+            with self._lock:
+                if len(self._plans) >= self.cache_size:
+                    self._plans.clear()
+
+                self._plans[cache_key] = plan
+
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
@@ -0,0 +1,211 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""KV cache
+
+Caches KV values for a device, filled by reads from the device and by
+notifications.  Each key has a freshness policy, set per key or per group:
+
+static  - fresh until the cache is cleared (reboot, format, new firmware)
+ttl     - fresh for a number of seconds after it was last updated
+push    - kept current by notifications, fresh while the device is online
+
+Reads of fresh values are served locally.  Concurrent readers of the same
+stale key share a single fetch from the device.
+"""
+
+import threading
+import time
+
+
+class KVPolicy(object):
+    def __init__(self, mode, ttl=None):
+        assert mode in ['static', 'ttl', 'push']
+
+        self.mode = mode
+        self.ttl = ttl
+
+    def __str__(self):
+        if self.mode == 'ttl':
+            return "ttl(%s)" % (self.ttl)
+
+        return self.mode
+
+    def is_fresh(self, updated_at, now, online):
+        if self.mode == 'static':
+            return True
+
+        elif self.mode == 'ttl':
+            return (now - updated_at) < self.ttl
+
+        else:
+            return online
+
+
+STATIC = KVPolicy('static')
+PUSH = KVPolicy('push')
+
+def ttl(seconds):
+    return KVPolicy('ttl', ttl=seconds)
+
+# always read from the device
+NEVER = ttl(0)
+
+
+class _Fetch(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.values = None
+        self.error = None
+
+
+class KVCache(object):
+    def __init__(self,
+                 fetch,
+                 group_of,
+                 online=None,
+                 default_policy=STATIC,
+                 group_policies=None):
+
+        # fetch(*keys) reads keys from the device and returns a dict.
+        # it is expected to call update() with the values it reads.
+        self._fetch = fetch
+
+        # group_of(key) returns the KV group of a key
+        self._group_of = group_of
+
+        # online() returns True if the device is online
+        self._online = online
+
+        self.default_policy = default_policy
+
+        self._key_policies = dict()
+        self._group_policies = dict()
+
+        if group_policies:
+            self._group_policies.update(group_policies)
+
+        # key -> (value, updated_at)
+        self._entries = dict()
+
+        # key -> _Fetch in progress
+        self._fetches = dict()
+
+        self._lock = threading.Lock()
+
+    def set_key_policy(self, key, policy):
+        self._key_policies[key] = policy
+
+    def set_group_policy(self, group, policy):
+        self._group_policies[group] = policy
+
+    def policy(self, key):
+        try:
+            return self._key_policies[key]
+
+        except KeyError:
+            pass
+
+        return self._group_policies.get(self._group_of(key), self.default_policy)
+
+    def update(self, key, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            self._entries[key] = (value, timestamp)
+
+    def invalidate(self, *keys):
+        # invalidate the given keys, or everything if no keys are given
+        with self._lock:
+            if len(keys) == 0:
+                self._entries.clear()
+
+            else:
+                for key in keys:
+                    self._entries.pop(key, None)
+
+    def peek(self, key):
+        # return cached value regardless of freshness, or None
+        try:
+            return self._entries[key][0]
+
+        except KeyError:
+            return None
+
+    def get(self, *keys):
+        results = dict()
+
+        fetch_keys = list()
+        waits = list()
+
+        now = time.time()
+
+        if self._online:
+            online = self._online()
+
+        else:
+            online = True
+
+        with self._lock:
+            fetch = None
+
+            for key in keys:
+                try:
+                    value, updated_at = self._entries[key]
+
+                    if self.policy(key).is_fresh(updated_at, now, online):
+                        results[key] = value
+                        continue
+
+                except KeyError:
+                    pass
+
+                # someone else is already reading this key
+                if key in self._fetches:
+                    waits.append((key, self._fetches[key]))
+                    continue
+
+                if fetch is None:
+                    fetch = _Fetch()
+
+                fetch_keys.append(key)
+                self._fetches[key] = fetch
+
+        if len(fetch_keys) > 0:
+            try:
+                fetch.values = self._fetch(*fetch_keys)
+
+                results.update(fetch.values)
+
+            except Exception as e:
+                fetch.error = e
+
+                raise
+
+            finally:
+                with self._lock:
+                    for key in fetch_keys:
+                        del self._fetches[key]
+
+                fetch.event.set()
+
+        for key, f in waits:
+            f.event.wait()
+
+            if f.error is not None:
+                raise f.error
+
+            results[key] = f.values[key]
+
+        return results
+
@@ -16,6 +16,11 @@ import struct
 from fields import *
 
 
+# the message type field is read and written with struct directly,
+# keyed by its size
+MSG_TYPE_STRUCTS = {1: struct.Struct('<B'), 2: struct.Struct('<H')}
+
+
 class Payload(StructField):
     
     msg_type_format = None
@@ -23,10 +28,12 @@ class Payload(StructField):
     fields = []
 
     def __init__(self, **kwargs):
-        super(Payload, self).__init__(fields=self.fields, **kwargs)
-        
-        if self.msg_type_format:
-            self.msg_type_format.value = self.msg_type
+        # fields are declared on the class, each message gets its own copy
+        # so messages can be built and sent from several threads at once.
+        # the shared message type field is never written to.
+        fields = [f.clone() for f in self.fields]
+
+        super(Payload, self).__init__(fields=fields, **kwargs)
     
     def size(self):
         field_size = super(Payload, self).size()
@@ -49,7 +56,7 @@ class Payload(StructField):
         s = ""
 
         if self.msg_type_format:
-            s = self.msg_type_format.pack()
+            s = MSG_TYPE_STRUCTS[self.msg_type_format.size()].pack(self.msg_type)
         
         s += super(Payload, self).pack()
 
@@ -71,6 +78,8 @@ class Protocol(object):
         for message in self.messages:
             message.msg_type_format = self.msg_type_format
             self.__msg_dict[message.msg_type] = message
+
+        self._msg_type_struct = MSG_TYPE_STRUCTS[self.msg_type_format.size()]
     
     def get_msgs(self):
         return [m[1] for m in inspect.getmembers(self) 
@@ -78,7 +87,7 @@ class Protocol(object):
 
     def unpack(self, data):
         # get message type from data
-        msg_type = self.msg_type_format.unpack(data).value
+        msg_type = self._msg_type_struct.unpack_from(data)[0]
         
         # initialize and unpack message
         try:
@@ -0,0 +1,226 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Network clock
+
+Converts wcom network time (a 32 bit microsecond counter, which wraps
+about every 71 minutes) to NTP time.  The gateway is asked for pairs of
+(network time, NTP time) in the background, and the most recent pairs are
+fitted with a line, so the offset and the drift between the two clocks are
+both accounted for.  Conversions only use the fitted model and never wait
+on the gateway.
+"""
+
+import threading
+import datetime
+import logging
+from collections import deque
+
+
+NTP_EPOCH = datetime.datetime(1900, 1, 1)
+
+NETWORK_TIME_WRAP           = 2**32
+
+# sync points kept for the fit
+MAX_SYNC_POINTS             = 16
+
+# seconds between syncs, and between retries after a failed sync
+REFRESH_INTERVAL            = 60.0
+RETRY_INTERVAL              = 10.0
+
+# network time is ambiguous more than half a wrap from the last sync
+MAX_SYNC_AGE                = datetime.timedelta(minutes=30)
+
+# sync points this far off the model mean a clock was reset, and the
+# model starts over
+MAX_RESIDUAL                = 1.0
+
+# span of network time needed before drift is estimated, and the most
+# drift believed
+MIN_FIT_SPAN                = 10 * 1000000
+MAX_DRIFT                   = 0.001
+
+NOMINAL_RATE                = 1.0 / 1000000.0
+
+
+class TimeNotSynchronizedException(Exception):
+    pass
+
+
+def _signed_delta(a, b):
+    # a - b on the wrapping counter, in the range +/- half a wrap
+    return ((a - b + NETWORK_TIME_WRAP / 2) % NETWORK_TIME_WRAP) - NETWORK_TIME_WRAP / 2
+
+
+class NetworkClock(object):
+    def __init__(self, refresh=None):
+        # refresh is called from the background thread to take a new
+        # sync point, and reports it through add_sync_point() or reset()
+        self.refresh = refresh
+
+        # (unwrapped network time, NTP seconds)
+        self._points = deque(maxlen=MAX_SYNC_POINTS)
+
+        # raw network time and local time of the latest sync point
+        self._last_raw = None
+        self._last_sync = None
+
+        # NTP seconds = intercept + rate * (unwrapped network time - origin)
+        self._origin = 0
+        self._intercept = 0.0
+        self._rate = NOMINAL_RATE
+
+        self._lock = threading.Lock()
+
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _unwrap(self, raw, ntp_seconds):
+        # choose the wrap which best matches the NTP time elapsed since
+        # the last point, so a long gap between syncs is still handled
+        last_x, last_ntp = self._points[-1]
+
+        delta = _signed_delta(raw, self._last_raw)
+        expected = (ntp_seconds - last_ntp) * 1000000.0
+
+        wraps = round((expected - delta) / NETWORK_TIME_WRAP)
+
+        return last_x + delta + int(wraps) * NETWORK_TIME_WRAP
+
+    def _predict(self, x):
+        return self._intercept + self._rate * (x - self._origin)
+
+    def _fit(self):
+        # least squares line through the sync points, relative to the
+        # first one to keep the sums small
+        x0, y0 = self._points[0]
+
+        n = len(self._points)
+        xs = [x - x0 for x, y in self._points]
+        ys = [y - y0 for x, y in self._points]
+
+        mean_x = float(sum(xs)) / n
+        mean_y = sum(ys) / n
+
+        sxx = sum([(x - mean_x) ** 2 for x in xs])
+        sxy = sum([(x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)])
+
+        rate = NOMINAL_RATE
+
+        if max(xs) - min(xs) >= MIN_FIT_SPAN and sxx > 0:
+            rate = sxy / sxx
+
+            if abs(rate / NOMINAL_RATE - 1.0) > MAX_DRIFT:
+                logging.debug("NetworkClock: implausible drift %.6f, ignored" % (rate / NOMINAL_RATE - 1.0))
+
+                rate = NOMINAL_RATE
+
+        self._origin = x0
+        self._rate = rate
+        self._intercept = y0 + mean_y - rate * mean_x
+
+    def add_sync_point(self, network_time, ntp_seconds):
+        # ntp_seconds is seconds since the NTP epoch, as a float
+        with self._lock:
+            if len(self._points) == 0:
+                x = network_time
+
+            else:
+                x = self._unwrap(network_time, ntp_seconds)
+
+                if abs(self._predict(x) - ntp_seconds) > MAX_RESIDUAL:
+                    logging.info("NetworkClock: clock step of %.3f sec, restarting model" % \
+                                 (ntp_seconds - self._predict(x)))
+
+                    self._points.clear()
+                    x = network_time
+
+            self._points.append((x, ntp_seconds))
+            self._last_raw = network_time
+            self._last_sync = datetime.datetime.utcnow()
+
+            self._fit()
+
+    def reset(self):
+        # the gateway is not synchronized
+        with self._lock:
+            self._points.clear()
+            self._last_raw = None
+            self._last_sync = None
+
+    def _model(self):
+        # snapshot of the model, so a batch is converted consistently
+        with self._lock:
+            if len(self._points) == 0 or \
+               datetime.datetime.utcnow() - self._last_sync > MAX_SYNC_AGE:
+                model = None
+
+            else:
+                model = (self._last_raw, self._points[-1][0], self._origin, self._intercept, self._rate)
+
+        if self._thread is None and self.refresh is not None:
+            self.start()
+
+        if model is None:
+            # ask for a sync, but don't wait for it
+            self._wake.set()
+
+            raise TimeNotSynchronizedException
+
+        return model
+
+    def convert(self, network_time):
+        return self.convert_many([network_time])[0]
+
+    def convert_many(self, network_times):
+        # returns a list of datetimes
+        last_raw, last_x, origin, intercept, rate = self._model()
+
+        return [NTP_EPOCH + datetime.timedelta(seconds=intercept + rate * (last_x + _signed_delta(t, last_raw) - origin))
+                for t in network_times]
+
+    def get_stats(self):
+        # drift is how fast the network clock runs relative to NTP
+        with self._lock:
+            return {"sync_points":  len(self._points),
+                    "drift":        NOMINAL_RATE / self._rate - 1.0,
+                    "last_sync":    self._last_sync}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.clear()
+
+            try:
+                self.refresh()
+
+            except Exception as e:
+                logging.debug("NetworkClock: sync failed: %s" % (e))
+
+                # conversions asking for a sync don't hurry a retry
+                self._stop_event.wait(RETRY_INTERVAL)
+                continue
+
+            self._wake.wait(REFRESH_INTERVAL)
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
@@ -14,8 +14,9 @@ import threading
 import time
 import logging
 
-from sapphire.core import KVObjectsManager
 from device import DeviceUnreachableException
+from registry import device_registry
+from group import DeviceGroup
 import gateway
 
 from pydispatch import dispatcher
@@ -24,56 +25,128 @@ SIGNAL_FOUND_DEVICE = "signal_found_device"
 
 DEFAULT_SCAN_INTERVAL           = 8.0
 
+# the scan interval doubles up to this while the network is quiet
+MAX_SCAN_INTERVAL               = 120.0
 
-def scan():
-    gateways = gateway.getGateways()
+# how long to wait for a gateway's device DB
+GATEWAY_TIMEOUT                 = 10.0
+
+
+def scan(gateway_timeout=GATEWAY_TIMEOUT, discovery=None):
+    # with a running GatewayDiscovery, its current gateways are used
+    # instead of broadcasting for them
+    if discovery is not None:
+        gateways = discovery.gateways()
+
+    else:
+        gateways = gateway.getGateways()
 
     devices = list()
 
     devices.extend(gateways)
 
-    try:
-        for g in gateways:
-            devices.extend(g.getDevices())        
+    # gateways are queried at once, so a slow or unreachable gateway
+    # doesn't hold up or hide the devices behind the others.  a gateway
+    # still busy with a call from an earlier scan isn't asked again.
+    group = DeviceGroup(gateways, timeout=gateway_timeout)
+
+    for g, result, error in group.imap('getDevices', blocking=False):
+        if error is not None:
+            logging.info("Gateway: %s device DB unavailable: %s" % (g.device_id, error))
+            continue
+
+        devices.extend(result)
+
+    for i in xrange(len(devices)):
+        new = devices[i].device_id not in device_registry
 
-    except:
-        pass
+        devices[i] = device_registry.register(devices[i])
 
-    for device in devices:
-        # check if device has been published
-        if len(KVObjectsManager.query(device_id=device.device_id)) == 0:
-            device.notify()   
+        # publish devices we haven't seen before
+        if new:
+            devices[i].notify()   
             
-        dispatcher.send(signal=SIGNAL_FOUND_DEVICE, device=device)
+            dispatcher.send(signal=SIGNAL_FOUND_DEVICE, device=devices[i])
 
     return devices
 
 
 class NetworkScanner(threading.Thread):
-    def __init__(self, scan_interval=DEFAULT_SCAN_INTERVAL):
+    def __init__(self, scan_interval=DEFAULT_SCAN_INTERVAL, max_scan_interval=MAX_SCAN_INTERVAL):
         super(NetworkScanner, self).__init__()
         
         self.scan_interval = scan_interval
+        self.max_scan_interval = max_scan_interval
+
+        # current interval, adapted to how often the network changes
+        self.interval = scan_interval
+
+        # (device_id, short_addr, host) of each device found by the last scan
+        self._network = None
         
         self._stop_event = threading.Event()
+        self._wake = threading.Event()
+
+        # gateways are discovered continuously, a new one is scanned
+        # right away
+        self.discovery = gateway.GatewayDiscovery()
+
+        dispatcher.connect(self._found_gateway, 
+                           signal=gateway.SIGNAL_FOUND_GATEWAY, 
+                           sender=self.discovery)
+
+        self.scans = 0
+        self.last_scan_duration = None
+        self.last_scan_devices = 0
 
         self.start()
 
+    def _found_gateway(self, gateway):
+        self.interval = self.scan_interval
+        self._wake.set()
+
     def run(self):
         logging.info("NetworkScanner started")
 
+        # give gateways a chance to answer the first poll
+        self.discovery.ready.wait(2.0)
+
         while not self._stop_event.is_set():
+            start = time.time()
+
+            self._wake.clear()
+
             try:
-                scan()
+                devices = scan(discovery=self.discovery)
+
+                self.last_scan_devices = len(devices)
+
+                network = set([(d.device_id, d.short_addr, d.host) for d in devices])
+
+                # scan again soon after a change, back off while quiet
+                if network != self._network:
+                    self.interval = self.scan_interval
+
+                else:
+                    self.interval = min(self.interval * 2, self.max_scan_interval)
+
+                self._network = network
             
             except DeviceUnreachableException as e:
                 logging.info(e)
+
+            self.scans += 1
+            self.last_scan_duration = time.time() - start
                 
-            self._stop_event.wait(self.scan_interval)
+            self._wake.wait(self.interval)
                 
+        self.discovery.stop()
+        self.discovery.join()
+
         logging.info("NetworkScanner stopped")
 
     def stop(self):
         logging.info("NetworkScanner shutting down")
         self._stop_event.set()
+        self._wake.set()
 
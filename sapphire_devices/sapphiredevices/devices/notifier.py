@@ -0,0 +1,138 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Notify coalescer
+
+Devices tend to report several keys in a burst.  Instead of publishing the
+device to the KV system once per notification, changed keys are gathered
+per device for a short window, or until a batch of keys has changed, and
+the device is published once with all of them.  The values and timestamps
+are already set on the device, so a single notify() carries them all.
+Publishes hold the device's KV lock, so they don't interleave with a
+notification being applied to it on another thread.
+
+Coalescing is off by default, as publishes still pending when a process
+exits would be lost.  The device server turns it on and flushes it on
+shutdown.
+"""
+
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+
+DEFAULT_WINDOW              = 0.1
+DEFAULT_BATCH_SIZE          = 32
+
+
+class NotifyCoalescer(object):
+    def __init__(self, window=DEFAULT_WINDOW, batch_size=DEFAULT_BATCH_SIZE):
+        # a window of 0 publishes every notification immediately, as
+        # does a stopped coalescer
+        self.window = window
+        self.batch_size = batch_size
+
+        self.stats = {"keys":       0,
+                      "publishes":  0}
+
+        # device_id -> [deadline, device, keys changed], in deadline order
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+
+        self._thread = None
+        self.running = True
+
+    def add(self, device, key):
+        if self.window <= 0 or not self.running:
+            self._publish(device)
+            return
+
+        with self._cond:
+            self.stats["keys"] += 1
+
+            try:
+                entry = self._pending[device.device_id]
+
+            except KeyError:
+                entry = [time.time() + self.window, device, 0]
+                self._pending[device.device_id] = entry
+
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+
+                self._cond.notify()
+
+            entry[2] += 1
+
+            if entry[2] < self.batch_size:
+                return
+
+            del self._pending[device.device_id]
+
+        self._publish(device)
+
+    def _publish(self, device):
+        self.stats["publishes"] += 1
+
+        try:
+            with device._kv_lock:
+                device.notify()
+
+        except Exception as e:
+            logging.error("NotifyCoalescer: Device: %s raised exception: %s" % (device.device_id, e))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.running:
+                    if len(self._pending) == 0:
+                        self._cond.wait()
+                        continue
+
+                    # oldest entry is the first to expire
+                    delay = self._pending.itervalues().next()[0] - time.time()
+
+                    if delay <= 0:
+                        break
+
+                    self._cond.wait(delay)
+
+                if not self.running:
+                    return
+
+                device_id, entry = self._pending.popitem(last=False)
+
+            self._publish(entry[1])
+
+    def flush(self):
+        with self._cond:
+            entries = self._pending.values()
+            self._pending.clear()
+
+        for entry in entries:
+            self._publish(entry[1])
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self.flush()
+
+
+notify_coalescer = NotifyCoalescer(window=0)
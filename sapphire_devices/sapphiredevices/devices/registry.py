@@ -0,0 +1,136 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Device registry
+
+Hash indexes of the known devices by device ID, by short address behind
+each gateway, and by host, so finding the device a notification or scan
+result belongs to doesn't depend on the size of the fleet.
+
+Devices are added by the network scanner, and re-indexed when their
+address attributes change.
+"""
+
+import threading
+
+
+# device attributes which are indexed
+INDEXED_KEYS = set(['device_id', 'short_addr', 'host'])
+
+
+def _gateway_id(device):
+    if device._gateway is not None:
+        return device._gateway.device_id
+
+    return None
+
+
+class DeviceRegistry(object):
+    def __init__(self):
+        self._by_id = dict()
+        self._by_short_addr = dict()
+        self._by_host = dict()
+
+        # id(device) -> (device_id, (gateway id, short_addr), host) the
+        # device is indexed under
+        self._indexed = dict()
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, device_id):
+        return device_id in self._by_id
+
+    def _index_keys(self, device):
+        return (device.device_id, (_gateway_id(device), device.short_addr), device.host)
+
+    def _add(self, device):
+        device_id, addr, host = self._index_keys(device)
+
+        self._by_id[device_id] = device
+        self._by_short_addr[addr] = device
+        self._by_host[host] = device
+
+        self._indexed[id(device)] = (device_id, addr, host)
+
+    def _remove(self, device):
+        device_id, addr, host = self._indexed.pop(id(device))
+
+        # another device may have taken over an address
+        if self._by_id.get(device_id) is device:
+            del self._by_id[device_id]
+
+        if self._by_short_addr.get(addr) is device:
+            del self._by_short_addr[addr]
+
+        if self._by_host.get(host) is device:
+            del self._by_host[host]
+
+    def register(self, device):
+        # returns the registered device with this device ID, which is
+        # the given device unless one was already registered
+        with self._lock:
+            try:
+                return self._by_id[device.device_id]
+
+            except KeyError:
+                pass
+
+            self._add(device)
+
+            return device
+
+    def update(self, device):
+        # re-index a device after its address attributes change
+        with self._lock:
+            if id(device) not in self._indexed:
+                return
+
+            if self._indexed[id(device)] == self._index_keys(device):
+                return
+
+            self._remove(device)
+            self._add(device)
+
+    def remove(self, device):
+        with self._lock:
+            if id(device) in self._indexed:
+                self._remove(device)
+
+    def get(self, device_id):
+        return self._by_id.get(device_id)
+
+    def get_by_short_addr(self, short_addr, gateway=None):
+        if gateway is not None:
+            gateway = gateway.device_id
+
+        return self._by_short_addr.get((gateway, short_addr))
+
+    def get_by_host(self, host):
+        return self._by_host.get(host)
+
+    def devices(self):
+        with self._lock:
+            return self._by_id.values()
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._by_short_addr.clear()
+            self._by_host.clear()
+            self._indexed.clear()
+
+
+# all devices known to this process
+device_registry = DeviceRegistry()
@@ -0,0 +1,285 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Firmware rollout
+
+Loads a firmware image onto a set of devices.  Uploads run concurrently,
+with a cap on the number of uploads in flight behind each gateway so a
+rollout doesn't saturate the mesh.  A canary batch is loaded first, and the
+rest of the fleet is only touched if all of the canaries succeed.  A
+device only counts as done once it has come back from the loader running
+the new image.
+"""
+
+import logging
+import time
+
+import firmware
+from group import DeviceGroup
+
+
+DEFAULT_MAX_WORKERS         = 8
+DEFAULT_PER_GATEWAY         = 2
+DEFAULT_CANARY_COUNT        = 1
+DEFAULT_TRIES               = 3
+DEFAULT_BACKOFF             = 2.0
+DEFAULT_MAX_BACKOFF         = 60.0
+
+# how long a device has to come back after loading, and how often it is
+# checked
+DEFAULT_VERIFY_TIMEOUT      = 120.0
+VERIFY_POLL_INTERVAL        = 5.0
+
+
+class RolloutAbortedException(Exception):
+    def __init__(self, value = None):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class FirmwareVerifyException(Exception):
+    pass
+
+
+class DeviceRolloutStatus(object):
+    def __init__(self, device):
+        self.device = device
+        self.state = 'pending'
+        self.bytes_written = 0
+        self.tries = 0
+        self.error = None
+        self.start_time = None
+        self.finish_time = None
+
+    def __str__(self):
+        s = "%24s %10s %7d bytes tries:%d" % \
+            (self.device.name,
+             self.state,
+             self.bytes_written,
+             self.tries)
+
+        if self.error:
+            s += " error:%s" % (self.error)
+
+        return s
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+
+        if self.finish_time is None:
+            return time.time() - self.start_time
+
+        return self.finish_time - self.start_time
+
+
+class FirmwareRollout(object):
+    def __init__(self,
+                 devices,
+                 firmware_id,
+                 max_workers=DEFAULT_MAX_WORKERS,
+                 per_gateway=DEFAULT_PER_GATEWAY,
+                 canary=DEFAULT_CANARY_COUNT,
+                 tries=DEFAULT_TRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF,
+                 verify_timeout=DEFAULT_VERIFY_TIMEOUT,
+                 progress=None):
+
+        # firmware_id can be a project name, verify compares against the ID
+        self.firmware_id = firmware.get_firmware_id(firmware_id)
+        self.max_workers = max_workers
+        self.per_gateway = per_gateway
+        self.canary = canary
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.verify_timeout = verify_timeout
+
+        # progress(status) is called on every state change and upload chunk
+        self._progress = progress
+
+        self.status = [DeviceRolloutStatus(d) for d in devices]
+
+        self.start_time = None
+        self.finish_time = None
+
+        # load the firmware image once for the whole rollout
+        fw_file = firmware.get_firmware(self.firmware_id)
+
+        if fw_file is None:
+            raise IOError("Firmware image not found")
+
+        f = open(fw_file, 'rb')
+        self._firmware_data = f.read()
+        f.close()
+
+    def _update(self, status, state=None):
+        if state:
+            status.state = state
+
+        if self._progress:
+            self._progress(status)
+
+    def _verify(self, device, status):
+        # wait for the device to come back from the loader and check it is
+        # running the image we loaded
+        self._update(status, 'verifying')
+
+        deadline = time.time() + self.verify_timeout
+
+        while True:
+            # don't trust firmware info cached before the reboot
+            device.invalidateFiles()
+
+            try:
+                fw_info = device.getFirmwareInfo()
+                break
+
+            except Exception as e:
+                if time.time() >= deadline:
+                    raise FirmwareVerifyException("Device did not come back after loading: %s" % (e))
+
+            time.sleep(VERIFY_POLL_INTERVAL)
+
+        if fw_info.firmware_id != self.firmware_id:
+            raise FirmwareVerifyException("Device is running %s after loading" % (fw_info.firmware_id))
+
+    def _load(self, device, status):
+        def progress(length):
+            status.bytes_written = length
+            self._update(status)
+
+        if status.start_time is None:
+            status.start_time = time.time()
+
+        status.tries += 1
+
+        self._update(status, 'uploading')
+
+        try:
+            device.loadFirmware(firmware_id=self.firmware_id,
+                                progress=progress,
+                                data=self._firmware_data)
+
+            self._verify(device, status)
+
+        except Exception as e:
+            status.error = e
+
+            logging.info("Rollout: %s try %d failed: %s" % (device.device_id, status.tries, e))
+
+            raise
+
+        status.error = None
+        status.finish_time = time.time()
+        self._update(status, 'done')
+
+    def _run_batch(self, batch):
+        pending = batch
+
+        while True:
+            statuses = dict([(s.device, s) for s in pending])
+
+            group = DeviceGroup([s.device for s in pending],
+                                max_workers=self.max_workers,
+                                per_gateway=self.per_gateway)
+
+            results, errors = group.call(lambda d: self._load(d, statuses[d]))
+
+            if len(errors) == 0:
+                return
+
+            pending = [statuses[d] for d in errors]
+
+            # give up on devices that are out of tries
+            for status in [s for s in pending if s.tries >= self.tries]:
+                status.finish_time = time.time()
+                self._update(status, 'failed')
+
+            pending = [s for s in pending if s.tries < self.tries]
+
+            if len(pending) == 0:
+                return
+
+            for status in pending:
+                self._update(status, 'pending')
+
+            # exponential backoff before the next round of tries
+            time.sleep(min(self.backoff * (2 ** (pending[0].tries - 1)), self.max_backoff))
+
+    def run(self):
+        self.start_time = time.time()
+
+        canaries = self.status[:self.canary]
+        remaining = self.status[self.canary:]
+
+        try:
+            if len(canaries) > 0:
+                logging.info("Rollout: loading %d canaries" % (len(canaries)))
+
+                self._run_batch(canaries)
+
+                failed = [s for s in canaries if s.state != 'done']
+
+                if len(failed) > 0:
+                    for status in remaining:
+                        self._update(status, 'skipped')
+
+                    raise RolloutAbortedException("%d of %d canaries failed" % (len(failed), len(canaries)))
+
+            logging.info("Rollout: loading %d devices" % (len(remaining)))
+
+            self._run_batch(remaining)
+
+        finally:
+            self.finish_time = time.time()
+
+        return self.summary()
+
+    def summary(self):
+        if self.start_time is None:
+            elapsed = 0.0
+
+        elif self.finish_time is None:
+            elapsed = time.time() - self.start_time
+
+        else:
+            elapsed = self.finish_time - self.start_time
+
+        done = [s for s in self.status if s.state == 'done']
+        total_bytes = sum([s.bytes_written for s in self.status])
+
+        if elapsed > 0:
+            bytes_per_sec = total_bytes / elapsed
+            devices_per_min = (len(done) / elapsed) * 60.0
+
+        else:
+            bytes_per_sec = 0.0
+            devices_per_min = 0.0
+
+        return {"devices": len(self.status),
+                "done": len(done),
+                "failed": len([s for s in self.status if s.state == 'failed']),
+                "skipped": len([s for s in self.status if s.state == 'skipped']),
+                "retries": sum([max(s.tries - 1, 0) for s in self.status]),
+                "elapsed": elapsed,
+                "bytes": total_bytes,
+                "bytes_per_sec": bytes_per_sec,
+                "devices_per_min": devices_per_min}
+
+
+def rollout(devices, firmware_id, **kwargs):
+    return FirmwareRollout(devices, firmware_id, **kwargs).run()
+
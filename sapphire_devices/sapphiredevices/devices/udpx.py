@@ -22,10 +22,23 @@ delivery with an automatic repeat request mechanism in the client.
 import socket
 import random
 import time
+import threading
 
 import bitstring
 
 
+# client transaction counters for the whole process
+stats = {"requests":     0,
+         "retries":      0,
+         "timeouts":     0}
+
+_stats_lock = threading.Lock()
+
+def _count(name):
+    with _stats_lock:
+        stats[name] += 1
+
+
 
 class Packet(object):
     
@@ -167,8 +180,13 @@ class ClientSocket(object):
         
         start = time.time()
 
+        _count("requests")
+
         # retry loop
         for i in xrange(self.__tries):
+            if i > 0:
+                _count("retries")
+
             # send packet
             try:
                 self.__sock.send(packet.pack())
@@ -223,6 +241,8 @@ class ClientSocket(object):
                 raise
 
         # we didn't receive an ack, raise the timeout exception
+        _count("timeouts")
+
         raise socket.timeout
     
     def recvfrom(self, bufsize=4096):
@@ -252,6 +272,9 @@ class ServerSocket(object):
         
         self.__ack_host = None
         self.__ack_packet = None
+
+        # if set, received datagrams are passed to capture.write(data, host)
+        self.capture = None
     
     def bind(self, address):
         self.__sock.bind(address)
@@ -259,6 +282,12 @@ class ServerSocket(object):
     def settimeout(self, seconds):
         self.__sock.settimeout(seconds)
     
+    def setsockopt(self, level, option, value):
+        self.__sock.setsockopt(level, option, value)
+
+    def close(self):
+        self.__sock.close()
+
     def getsockname(self):
         return self.__sock.getsockname()
 
@@ -283,6 +312,9 @@ class ServerSocket(object):
         # receive packet and host address
         try:
             data, host = self.__sock.recvfrom(bufsize)
+
+            if self.capture:
+                self.capture.write(data, host)
             
             # parse packet
             packet = Packet().unpack(data)
@@ -0,0 +1,206 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Notification capture and replay
+
+A capture file holds raw UDPX datagrams as received by the notification
+server, each with its arrival time and source address:
+
+    header:     magic (4 bytes)
+    record:     arrival time (double), IPv4 address (4 bytes), port (uint16),
+                length (uint16), datagram
+
+Replaying a capture sends the datagrams back to a server from one socket per
+original source, at the captured pace, a multiple of it, or as fast as
+possible.  The acks sent back by the server are read and counted.
+"""
+
+import socket
+import struct
+import threading
+import time
+import argparse
+import select
+
+
+CAPTURE_MAGIC = "SNC1"
+
+RECORD_HEADER = struct.Struct('<d4sHH')
+
+
+class CaptureWriter(object):
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+
+        self._lock = threading.Lock()
+
+    def write(self, data, host, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        header = RECORD_HEADER.pack(timestamp, socket.inet_aton(host[0]), host[1], len(data))
+
+        with self._lock:
+            self._file.write(header + data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(filename):
+    # yields (timestamp, host, data)
+    with open(filename, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a capture file" % (filename))
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+
+            if len(header) < RECORD_HEADER.size:
+                return
+
+            timestamp, addr, port, length = RECORD_HEADER.unpack(header)
+
+            data = f.read(length)
+
+            # truncated by a crash while writing
+            if len(data) < length:
+                return
+
+            yield timestamp, (socket.inet_ntoa(addr), port), data
+
+
+def read_captures(filenames):
+    # merge several capture files (one per intake process) by arrival time
+    records = list()
+
+    for filename in filenames:
+        records.extend(read_capture(filename))
+
+    records.sort(key=lambda r: r[0])
+
+    return records
+
+
+def replay(records, address, rate=1.0):
+    # rate is a multiple of the captured pace, 0 sends as fast as possible.
+    # returns (datagrams sent, acks received, elapsed seconds).
+    socks = dict()
+
+    acks = [0]
+    done = threading.Event()
+
+    def read_acks():
+        while True:
+            ready = select.select(socks.values(), [], [], 0.1)[0]
+
+            if len(ready) == 0 and done.is_set():
+                break
+
+            for s in ready:
+                try:
+                    s.recv(4096)
+                    acks[0] += 1
+
+                except socket.error:
+                    pass
+
+    sent = 0
+    start = time.time()
+    first = None
+
+    ack_thread = None
+
+    for timestamp, host, data in records:
+        if first is None:
+            first = timestamp
+
+        if rate > 0:
+            delay = (timestamp - first) / rate - (time.time() - start)
+
+            if delay > 0:
+                time.sleep(delay)
+
+        # one socket per captured source, so the server sees as many
+        # senders as it did when the capture was made
+        try:
+            sock = socks[host]
+
+        except KeyError:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            socks[host] = sock
+
+            if ack_thread is None:
+                ack_thread = threading.Thread(target=read_acks)
+                ack_thread.start()
+
+        while True:
+            try:
+                sock.sendto(data, address)
+                break
+
+            except socket.error:
+                # send buffer is full
+                time.sleep(0.001)
+
+        sent += 1
+
+    elapsed = time.time() - start
+
+    # give the server a moment to ack the tail end
+    time.sleep(0.5)
+    done.set()
+
+    if ack_thread is not None:
+        ack_thread.join()
+
+    for sock in socks.itervalues():
+        sock.close()
+
+    return sent, acks[0], elapsed
+
+
+def main():
+    from notification_server import NOTIFICATION_SERVER_PORT
+
+    parser = argparse.ArgumentParser(description='Replay captured notifications')
+    parser.add_argument('files', nargs='+', help='capture files')
+    parser.add_argument('--host', default='127.0.0.1', help='notification server host')
+    parser.add_argument('--port', type=int, default=NOTIFICATION_SERVER_PORT)
+    parser.add_argument('--rate',
+                        type=float,
+                        default=1.0,
+                        help='multiple of the captured rate, 0 for maximum rate')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to replay')
+
+    args = parser.parse_args()
+
+    records = read_captures(args.files)
+
+    print "Loaded %d datagrams" % (len(records))
+
+    for i in xrange(args.repeat):
+        sent, acks, elapsed = replay(records, (args.host, args.port), rate=args.rate)
+
+        print "Sent %d datagrams in %.2f sec (%.0f/sec), %d acks" % \
+            (sent, elapsed, sent / max(elapsed, 0.000001), acks)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,19 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
-# 
-# 
+#
+#
 # Copyright 2013 Sapphire Open Systems
-#  
+#
 # </license>
 #
 
 import threading
 import time
 import logging
+import heapq
+import itertools
+from Queue import Queue
 from datetime import datetime, timedelta
 
 from sapphire.automaton import *
@@ -22,106 +25,298 @@ from notification_server import NOTIFICATION_SERVER_PORT
 
 from pydispatch import dispatcher
 
+
+WATCHDOG_TIMEOUT            = 120.0
+RETRY_TIMEOUT               = 60.0
+
+# threads connecting to and scanning devices.  connects to devices which
+# have just sent a notification get their own workers, so they don't wait
+# behind retries to unreachable devices.
+DEFAULT_WORKERS             = 8
+DEFAULT_PRIORITY_WORKERS    = 4
+
 _monitors = dict()
+_scheduler = None
+_lock = threading.Lock()
 
 # add/remove event handling
 # these events come from netscan, which uses the dispatcher
 def found_device(device):
-    if device.device_id not in _monitors:
+    global _scheduler
+
+    with _lock:
+        if device.device_id in _monitors:
+            return
+
+        if _scheduler is None:
+            _scheduler = _Scheduler()
+
         logging.info("Adding device: %s" % (device.device_id))
 
-        _monitors[device.device_id] = _DeviceMonitor(device)
+        _monitors[device.device_id] = _DeviceMonitor(device, _scheduler)
 
 dispatcher.connect(found_device, signal=SIGNAL_FOUND_DEVICE)
 
+# notifications feed the watchdog and wake up devices waiting to retry
+def kv_updated(device):
+    try:
+        monitor = _monitors[device.device_id]
 
+    except KeyError:
+        return
+
+    monitor.notification()
+
+dispatcher.connect(kv_updated, signal=SIGNAL_KV_UPDATED)
+
+
+class _Scheduler(threading.Thread):
+    def __init__(self, workers=DEFAULT_WORKERS, priority_workers=DEFAULT_PRIORITY_WORKERS):
+        super(_Scheduler, self).__init__()
+
+        # (due time, sequence, func, args)
+        self._timers = list()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+        self._work = Queue()
+        self._workers = [threading.Thread(target=self._worker, args=(self._work,))
+                         for i in xrange(workers)]
+
+        self._priority_work = Queue()
+        self._workers += [threading.Thread(target=self._worker, args=(self._priority_work,))
+                          for i in xrange(priority_workers)]
 
-class _DeviceMonitor(threading.Thread):
-    def __init__(self, device=None):
-        super(_DeviceMonitor, self).__init__()
-        
-        self.device = device
-        
         self.running = True
 
+        # how late the last timer ran, and the worst so far
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+        for w in self._workers:
+            w.start()
+
         self.start()
-    
-    def set_server(self):
-        self.device.set_kv_server(port=NOTIFICATION_SERVER_PORT)
 
-    def scan(self):
-        self.device.scan()
-        self.device.getAllKV()
+    # timers run on the scheduler thread and must not block
+    def call_later(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._timers, (time.time() + delay, self._seq.next(), func, args))
 
-    def run(self):
-        logging.info("DeviceMonitor:%s running" % (self.device.device_id))
+            self._cond.notify()
 
-        while self.running:
-            try:
-                retry_timeout = 60
+    # submitted work runs on the worker pool
+    def submit(self, func, *args):
+        self._work.put((func, args))
 
-                self.set_server()
+    def submit_priority(self, func, *args):
+        self._priority_work.put((func, args))
 
-                self.scan()
+    def _worker(self, work):
+        while True:
+            item = work.get()
 
-                self.device._last_notification_timestamp = datetime.utcnow()
-                self.device.notify()
+            if item is None:
+                return
 
-                # device is online
-                logging.info("Device: %s online" % (self.device.device_id))
+            func, args = item
 
-                # watchdog
-                while self.device.device_status == "online":
-                    time.sleep(1.0)
+            try:
+                func(*args)
 
-                    if not self.running:
-                        break
+            except Exception as e:
+                logging.error("DeviceMonitor: worker raised exception: %s: %s" % (type(e), e))
 
-                    # check last notification time
-                    if (datetime.utcnow() - self.device._last_notification_timestamp) > timedelta(minutes=2):
-                        logging.info("Device: %s watchdog timeout" % (self.device.device_id))
+    def run(self):
+        while True:
+            with self._cond:
+                while self.running:
+                    if len(self._timers) == 0:
+                        self._cond.wait()
+                        continue
 
-                        # clear retry timeout so we'll try immediately
-                        retry_timeout = 0
+                    delay = self._timers[0][0] - time.time()
 
+                    if delay <= 0:
                         break
 
-                self.device.device_status = "offline"
-                logging.info("Device: %s offline" % (self.device.device_id))
+                    self._cond.wait(delay)
+
+                if not self.running:
+                    break
 
-            except DeviceUnreachableException:
-                logging.info("Device: %s unreachable" % (self.device.device_id))
-                pass
+                due, seq, func, args = heapq.heappop(self._timers)
+
+            self.lag = time.time() - due
+            self.max_lag = max(self.max_lag, self.lag)
+
+            try:
+                func(*args)
 
             except Exception as e:
-                raise
-                #logging.error("DeviceMonitor: %s raised exception: %s: %s" % (self.device.device_id, type(e), e))
+                logging.error("DeviceMonitor: timer raised exception: %s: %s" % (type(e), e))
 
-            # wait up to retry_timeout seconds before retrying device
-            for i in xrange(retry_timeout):
-                time.sleep(1.0)
+        for w in self._workers:
+            self._work.put(None)
+            self._priority_work.put(None)
 
-                # check status
-                if self.device.device_status == "online":
-                    break
+    def get_stats(self):
+        return {"timers":           len(self._timers),
+                "work_queued":      self._work.qsize(),
+                "priority_queued":  self._priority_work.qsize(),
+                "lag":              self.lag,
+                "max_lag":          self.max_lag}
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+
+            self._cond.notify()
 
-                if not self.running:
-                    break
-            
 
-        logging.info("DeviceMonitor:%d stopped" % (self.device.device_id))
+class _DeviceMonitor(object):
+    def __init__(self, device, scheduler):
+        self.device = device
+        self.scheduler = scheduler
+
+        # connecting, online, waiting or stopped
+        self.state = None
+
+        # bumped on each state change, timers from an earlier state are
+        # ignored when they expire
+        self._generation = 0
+
+        self._lock = threading.Lock()
+
+        logging.info("DeviceMonitor:%s running" % (self.device.device_id))
+
+        with self._lock:
+            self._connect()
+
+    def _set_state(self, state):
+        self.state = state
+        self._generation += 1
+
+    def _call_later(self, delay, func):
+        self.scheduler.call_later(delay, self._timer, self._generation, func)
+
+    def _timer(self, generation, func):
+        with self._lock:
+            if generation == self._generation:
+                func()
+
+    def _connect(self, priority=False):
+        self._set_state("connecting")
+
+        if priority:
+            self.scheduler.submit_priority(self._run_connect, self._generation)
+
+        else:
+            self.scheduler.submit(self._run_connect, self._generation)
+
+    def _run_connect(self, generation):
+        try:
+            self.device.set_kv_server(port=NOTIFICATION_SERVER_PORT)
+
+            self.device.scan(all_keys=True)
+
+            self.device._last_notification_timestamp = datetime.utcnow()
+            self.device.notify()
+
+        except DeviceUnreachableException:
+            logging.info("Device: %s unreachable" % (self.device.device_id))
+
+            self._timer(generation, self._wait)
+
+            return
+
+        except Exception as e:
+            logging.error("DeviceMonitor: %s raised exception: %s: %s" % (self.device.device_id, type(e), e))
+
+            self._timer(generation, self._wait)
+
+            return
+
+        self._timer(generation, self._online)
+
+    def _online(self):
+        # device is online
+        logging.info("Device: %s online" % (self.device.device_id))
+
+        self._set_state("online")
+        self._call_later(WATCHDOG_TIMEOUT, self._watchdog)
+
+    def _offline(self, retry_timeout=RETRY_TIMEOUT):
+        self.device.device_status = "offline"
+        self.device.invalidateFiles()
+        logging.info("Device: %s offline" % (self.device.device_id))
+
+        self._wait(retry_timeout)
+
+    def _wait(self, retry_timeout=RETRY_TIMEOUT):
+        # wait up to retry_timeout seconds before retrying device.
+        # a notification from the device will retry it sooner.
+        if retry_timeout <= 0:
+            self._connect()
+
+        else:
+            self._set_state("waiting")
+            self._call_later(retry_timeout, self._connect)
+
+    def _watchdog(self):
+        if self.device.device_status != "online":
+            self._offline()
+            return
+
+        # notifications don't touch the timer, instead it is re-armed
+        # here from the last notification time
+        elapsed = datetime.utcnow() - self.device._last_notification_timestamp
+
+        if elapsed > timedelta(seconds=WATCHDOG_TIMEOUT):
+            logging.info("Device: %s watchdog timeout" % (self.device.device_id))
+
+            # retry immediately
+            self._offline(retry_timeout=0)
+
+        else:
+            self._call_later(WATCHDOG_TIMEOUT - elapsed.total_seconds(), self._watchdog)
+
+    def notification(self):
+        with self._lock:
+            # device came back while we were waiting to retry
+            if self.state == "waiting" and self.device.device_status == "online":
+                self._connect(priority=True)
+
+            # device rebooted
+            elif self.state == "online" and self.device.device_status != "online":
+                self._offline()
 
     def stop(self):
         logging.info("DeviceMonitor:%d shutting down" % (self.device.short_addr))
-        self.running = False
 
+        with self._lock:
+            self._set_state("stopped")
 
-def stop():
-    for monitor in _monitors.itervalues():
-        monitor.stop()
 
+def get_stats():
+    stats = {"devices":          len(_monitors),
+             "online":           len([m for m in _monitors.values() if m.state == "online"]),
+             "timers":           0,
+             "work_queued":      0,
+             "priority_queued":  0,
+             "lag":              0.0,
+             "max_lag":          0.0}
 
+    if _scheduler is not None:
+        stats.update(_scheduler.get_stats())
 
+    return stats
 
 
+def stop():
+    with _lock:
+        for monitor in _monitors.itervalues():
+            monitor.stop()
 
+        if _scheduler is not None:
+            _scheduler.stop()
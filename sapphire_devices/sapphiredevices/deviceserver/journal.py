@@ -0,0 +1,252 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Notification journal
+
+An append-only log of applied notifications, so device state survives a
+restart of the server.  Records are written by a committer thread in
+batches, with one fsync per batch, when enough data is pending or after a
+short interval.
+
+The journal is split into segments.  Each new segment starts with the
+latest record of every key seen so far, after which the older segments are
+deleted, so recovery only reads the last segment or two no matter how long
+the server has been running.  A record torn by a crash is detected by its
+CRC, and recovery stops at it.
+
+Recovered values are restored to each device when it is found, and
+published once.
+"""
+
+import os
+import struct
+import threading
+import logging
+import marshal
+import zlib
+
+from pydispatch import dispatcher
+
+from sapphiredevices.devices.device import ntp_to_datetime
+from sapphiredevices.devices.netscan import SIGNAL_FOUND_DEVICE
+
+
+SEGMENT_SIZE                = 64 * 1024 * 1024
+
+# group commit thresholds
+SYNC_BYTES                  = 256 * 1024
+SYNC_INTERVAL               = 0.1
+
+SEGMENT_PREFIX              = "journal-"
+SEGMENT_EXT                 = ".log"
+
+# record length and CRC32
+RECORD_HEADER = struct.Struct('<II')
+
+
+def pack_record(data):
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+
+def read_segment(filename):
+    # yields records up to the end of the segment, or the first bad one
+    with open(filename, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+
+            if len(header) < RECORD_HEADER.size:
+                return
+
+            length, crc = RECORD_HEADER.unpack(header)
+
+            data = f.read(length)
+
+            if len(data) < length or (zlib.crc32(data) & 0xffffffff) != crc:
+                logging.warn("Journal: %s truncated" % (filename))
+                return
+
+            yield data
+
+
+class Journal(threading.Thread):
+    def __init__(self,
+                 path,
+                 segment_size=SEGMENT_SIZE,
+                 sync_bytes=SYNC_BYTES,
+                 sync_interval=SYNC_INTERVAL):
+
+        super(Journal, self).__init__()
+
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_bytes = sync_bytes
+        self.sync_interval = sync_interval
+
+        self.stats = {"records":    0,
+                      "commits":    0,
+                      "segments":   0}
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # (device_id, group, id) -> latest packed record
+        self._latest = dict()
+
+        # device_id -> list of records recovered at startup, not yet
+        # restored to the device
+        self.recovered = dict()
+
+        self._recover()
+
+        # (key, packed record) waiting to be committed
+        self._pending = list()
+        self._pending_bytes = 0
+
+        self._cond = threading.Condition()
+        self.running = True
+
+        self._file = None
+        self._segment = self._segments()[-1] if len(self._segments()) > 0 else 0
+        self._rotate()
+
+        dispatcher.connect(self.restore, signal=SIGNAL_FOUND_DEVICE)
+
+        self.start()
+
+    def _segments(self):
+        # segment numbers, oldest first
+        return sorted([int(f[len(SEGMENT_PREFIX):-len(SEGMENT_EXT)]) for f in os.listdir(self.path)
+                        if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_EXT)])
+
+    def _segment_file(self, segment):
+        return os.path.join(self.path, "%s%010d%s" % (SEGMENT_PREFIX, segment, SEGMENT_EXT))
+
+    def _recover(self):
+        count = 0
+
+        for segment in self._segments():
+            for data in read_segment(self._segment_file(segment)):
+                record = marshal.loads(data)
+
+                self._latest[record[:3]] = pack_record(data)
+                count += 1
+
+        for data in self._latest.itervalues():
+            record = marshal.loads(data[RECORD_HEADER.size:])
+
+            self.recovered.setdefault(record[0], list()).append(record)
+
+        logging.info("Journal: recovered %d keys for %d devices from %d records" % \
+                    (len(self._latest), len(self.recovered), count))
+
+    def _rotate(self):
+        # start a new segment with a snapshot of the latest records, then
+        # the older segments are no longer needed
+        if self._file is not None:
+            self._file.close()
+
+        self._segment += 1
+        self._segment_bytes = 0
+
+        self._file = open(self._segment_file(self._segment), 'ab')
+
+        snapshot = ''.join(self._latest.itervalues())
+
+        self._file.write(snapshot)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._segment_bytes += len(snapshot)
+        self.stats["segments"] += 1
+
+        for segment in self._segments():
+            if segment < self._segment:
+                os.remove(self._segment_file(segment))
+
+    def append(self, notification, key):
+        # notification is the decoded tuple from the notification server:
+        # (device_id, group, id, data_type, value, ntp seconds, ntp fraction)
+        data = pack_record(marshal.dumps(tuple(notification) + (key,)))
+
+        with self._cond:
+            self._pending.append((notification[:3], data))
+            self._pending_bytes += len(data)
+
+            if self._pending_bytes >= self.sync_bytes:
+                self._cond.notify()
+
+    def _commit(self, batch):
+        buf = ''.join([data for key, data in batch])
+
+        self._file.write(buf)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        for key, data in batch:
+            self._latest[key] = data
+
+        self._segment_bytes += len(buf)
+
+        self.stats["records"] += len(batch)
+        self.stats["commits"] += 1
+
+        if self._segment_bytes >= self.segment_size:
+            self._rotate()
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self.running and self._pending_bytes < self.sync_bytes:
+                    self._cond.wait(self.sync_interval)
+
+                batch = self._pending
+                self._pending = list()
+                self._pending_bytes = 0
+
+                running = self.running
+
+            if len(batch) > 0:
+                try:
+                    self._commit(batch)
+
+                except (IOError, OSError) as e:
+                    logging.error("Journal: commit failed: %s" % (e))
+
+            if not running:
+                break
+
+        self._file.close()
+
+        logging.info("Journal stopped")
+
+    def restore(self, device):
+        # apply recovered values to a device, as if they had just been
+        # notified, and publish them
+        try:
+            records = self.recovered.pop(device.device_id)
+
+        except KeyError:
+            return
+
+        for device_id, group, id, data_type, value, seconds, fraction, key in records:
+            device.set(key, value, timestamp=ntp_to_datetime(seconds, fraction))
+
+        device.notify()
+
+    def stop(self):
+        logging.info("Journal shutting down")
+
+        dispatcher.disconnect(self.restore, signal=SIGNAL_FOUND_DEVICE)
+
+        with self._cond:
+            self.running = False
+            self._cond.notify()
@@ -14,10 +14,14 @@ from sapphire.automaton import *
 
 import device_monitor
 from sapphiredevices.devices.netscan import NetworkScanner
+from sapphiredevices.devices.notifier import notify_coalescer, DEFAULT_WINDOW
 from sapphire.core.settings import get_app_dir
 from sapphire.core import settings
 
 from notification_server import NotificationServer
+from recorder import TelemetryRecorder, TelemetryStore, DEFAULT_SAMPLE_INTERVAL
+from journal import Journal
+from metrics import MetricsServer, METRICS_PORT
 
 import os
 import sys
@@ -28,17 +32,83 @@ VERSION = 0.3
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Sapphire Device Server')
+    parser.add_argument('--notification-processes', 
+                        type=int, 
+                        default=1,
+                        help='number of processes receiving notifications')
+
+    parser.add_argument('--capture', 
+                        default=None,
+                        help='capture received notifications to this file')
+
+    parser.add_argument('--metrics-port', 
+                        type=int, 
+                        default=METRICS_PORT,
+                        help='local port to serve metrics on, 0 to disable')
+
+    parser.add_argument('--telemetry', 
+                        default=None,
+                        help='record device telemetry to this directory')
+
+    parser.add_argument('--telemetry-keys', 
+                        default=None,
+                        help='comma separated keys to record, default is sys_stats')
+
+    parser.add_argument('--telemetry-interval', 
+                        type=float, 
+                        default=DEFAULT_SAMPLE_INTERVAL,
+                        help='seconds between telemetry samples')
+
+    args, unknown = parser.parse_known_args()
+
     settings.init()
     
     logging.info("Sapphire Device Server v%s" % (str(VERSION)))
     logging.info("Process ID: %d" % (os.getpid()))
 
+    # coalesce publishes, stop() below flushes what is pending
+    notify_coalescer.window = DEFAULT_WINDOW
+
+    # the intake processes are forked before any other thread is
+    # started, so they don't inherit locks held by those threads, or
+    # their sockets and files.  no device is known until the scanner
+    # runs, so nothing is applied before the journal is attached.
+    notif_server = NotificationServer(processes=args.notification_processes, 
+                                      capture=args.capture)
+
+    # recover state before devices are found
+    journal = Journal(os.path.join(get_app_dir(), "journal"))
+    notif_server.journal = journal
+
     scanner = NetworkScanner()
-    notif_server = NotificationServer()
 
+    recorder = None
+
+    if args.telemetry:
+        keys = None
+
+        if args.telemetry_keys:
+            keys = [k.strip() for k in args.telemetry_keys.split(',')]
+
+        recorder = TelemetryRecorder(TelemetryStore(args.telemetry),
+                                     keys=keys,
+                                     interval=args.telemetry_interval)
+
+    metrics = None
+
+    if args.metrics_port:
+        metrics = MetricsServer(notification_server=notif_server,
+                                scanner=scanner,
+                                journal=journal,
+                                port=args.metrics_port)
 
     run()
 
+    if metrics:
+        metrics.stop()
+        metrics.join()
+
     device_monitor.stop()
 
     scanner.stop()
@@ -47,6 +117,16 @@ def main():
     notif_server.stop()
     notif_server.join()
 
+    journal.stop()
+    journal.join()
+
+    # publish anything still waiting
+    notify_coalescer.stop()
+
+    if recorder:
+        recorder.stop()
+        recorder.join()
+
 
 if __name__ == "__main__":
     main()
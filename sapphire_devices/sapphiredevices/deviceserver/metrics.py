@@ -0,0 +1,239 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Metrics
+
+A small HTTP server on localhost reporting the device server's counters:
+
+    /metrics        Prometheus text format
+    /metrics.json   JSON, including rates over the last minute of requests
+"""
+
+import threading
+import time
+import json
+import logging
+from datetime import datetime
+from collections import deque
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from sapphiredevices.devices import udpx
+from sapphiredevices.devices.device import NTP_EPOCH
+from sapphiredevices.devices.registry import device_registry
+
+import device_monitor
+
+
+METRICS_PORT                = 59998
+
+# window over which rates are computed
+RATE_WINDOW                 = 60.0
+
+# counters which are also reported as per second rates
+RATE_COUNTERS = ["received", "applied", "dropped", "invalid", "not_found", "errors"]
+
+# name, type, help, section, key
+PROMETHEUS_METRICS = [
+    ("sapphire_notifications_received_total", "counter", "Notification datagrams received", "notifications", "received"),
+    ("sapphire_notifications_applied_total", "counter", "Notifications applied to devices", "notifications", "applied"),
+    ("sapphire_notifications_dropped_total", "counter", "Notifications dropped without ack while overloaded", "notifications", "dropped"),
+    ("sapphire_notifications_invalid_total", "counter", "Notifications which failed to decode", "notifications", "invalid"),
+    ("sapphire_notifications_unknown_device_total", "counter", "Notifications from unknown devices", "notifications", "not_found"),
+    ("sapphire_notifications_errors_total", "counter", "Notifications which failed to apply", "notifications", "errors"),
+    ("sapphire_notifications_queued", "gauge", "Notifications waiting to be applied", "notifications", "queued"),
+    ("sapphire_notifications_queue_high_water", "gauge", "Deepest notification queue seen", "notifications", "high_water"),
+    ("sapphire_scanner_scans_total", "counter", "Network scans completed", "scanner", "scans"),
+    ("sapphire_scanner_duration_seconds", "gauge", "Duration of the last network scan", "scanner", "last_duration"),
+    ("sapphire_scanner_devices", "gauge", "Devices found by the last network scan", "scanner", "devices"),
+    ("sapphire_scanner_interval_seconds", "gauge", "Current network scan interval", "scanner", "interval"),
+    ("sapphire_scanner_gateways", "gauge", "Gateways answering discovery polls", "scanner", "gateways"),
+    ("sapphire_monitor_devices", "gauge", "Monitored devices", "monitor", "devices"),
+    ("sapphire_monitor_online", "gauge", "Monitored devices online", "monitor", "online"),
+    ("sapphire_monitor_timers", "gauge", "Pending monitor timers", "monitor", "timers"),
+    ("sapphire_monitor_work_queued", "gauge", "Monitor connects waiting for a worker", "monitor", "work_queued"),
+    ("sapphire_monitor_priority_queued", "gauge", "Notified device connects waiting for a worker", "monitor", "priority_queued"),
+    ("sapphire_monitor_lag_seconds", "gauge", "How late the last monitor timer ran", "monitor", "lag"),
+    ("sapphire_monitor_max_lag_seconds", "gauge", "Latest a monitor timer has run", "monitor", "max_lag"),
+    ("sapphire_udpx_requests_total", "counter", "UDPX client requests", "udpx", "requests"),
+    ("sapphire_udpx_retries_total", "counter", "UDPX client retransmits", "udpx", "retries"),
+    ("sapphire_udpx_timeouts_total", "counter", "UDPX client requests which timed out", "udpx", "timeouts"),
+    ("sapphire_journal_records_total", "counter", "Records written to the journal", "journal", "records"),
+    ("sapphire_journal_commits_total", "counter", "Journal group commits", "journal", "commits"),
+]
+
+
+class _Rates(object):
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+
+        # (time, counters)
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    def update(self, counters):
+        now = time.time()
+
+        with self._lock:
+            self._samples.append((now, counters))
+
+            while now - self._samples[0][0] > self.window:
+                self._samples.popleft()
+
+            then, old = self._samples[0]
+
+        elapsed = now - then
+
+        if elapsed <= 0:
+            return dict([(k, 0.0) for k in counters])
+
+        return dict([(k, (counters[k] - old[k]) / elapsed) for k in counters])
+
+
+class MetricsServer(threading.Thread):
+    def __init__(self,
+                 notification_server=None,
+                 scanner=None,
+                 journal=None,
+                 port=METRICS_PORT,
+                 host='127.0.0.1'):
+
+        super(MetricsServer, self).__init__()
+
+        self.notification_server = notification_server
+        self.scanner = scanner
+        self.journal = journal
+
+        self._rates = _Rates()
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus()
+                    content_type = "text/plain; version=0.0.4"
+
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.collect(), indent=2, sort_keys=True)
+                    content_type = "application/json"
+
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics: " + format % args)
+
+        self._httpd = HTTPServer((host, port), Handler)
+
+        self.start()
+
+    def collect(self):
+        metrics = dict()
+
+        if self.notification_server is not None:
+            metrics["notifications"] = self.notification_server.get_stats()
+
+            metrics["notifications"]["rates"] = \
+                self._rates.update(dict([(k, metrics["notifications"][k]) for k in RATE_COUNTERS]))
+
+        if self.scanner is not None:
+            metrics["scanner"] = {"scans":          self.scanner.scans,
+                                  "last_duration":  self.scanner.last_scan_duration,
+                                  "devices":        self.scanner.last_scan_devices,
+                                  "interval":       self.scanner.interval,
+                                  "gateways":       len(self.scanner.discovery.gateways())}
+
+        if self.journal is not None:
+            metrics["journal"] = dict(self.journal.stats)
+
+        metrics["monitor"] = device_monitor.get_stats()
+        metrics["udpx"] = dict(udpx.stats)
+
+        # seconds since each device was last heard from
+        now = datetime.utcnow()
+        devices = dict()
+
+        for device in device_registry.devices():
+            last_seen = None
+
+            if device._last_notification_timestamp != NTP_EPOCH:
+                last_seen = (now - device._last_notification_timestamp).total_seconds()
+
+            devices[str(device.device_id)] = {"status":     device.device_status,
+                                              "last_seen":  last_seen}
+
+        metrics["devices"] = devices
+
+        return metrics
+
+    def prometheus(self):
+        metrics = self.collect()
+
+        lines = list()
+
+        for name, type, help, section, key in PROMETHEUS_METRICS:
+            try:
+                value = metrics[section][key]
+
+            except KeyError:
+                continue
+
+            if value is None:
+                continue
+
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            lines.append("%s %s" % (name, value))
+
+        if "notifications" in metrics:
+            lines.append("# HELP sapphire_notifications_queue_depth Notifications waiting per worker")
+            lines.append("# TYPE sapphire_notifications_queue_depth gauge")
+
+            for i, depth in enumerate(metrics["notifications"]["queue_depths"]):
+                lines.append('sapphire_notifications_queue_depth{worker="%d"} %d' % (i, depth))
+
+        lines.append("# HELP sapphire_device_last_seen_seconds Seconds since the last notification from a device")
+        lines.append("# TYPE sapphire_device_last_seen_seconds gauge")
+
+        for device_id, device in sorted(metrics["devices"].iteritems()):
+            if device["last_seen"] is not None:
+                lines.append('sapphire_device_last_seen_seconds{device_id="%s"} %.3f' % \
+                            (device_id, device["last_seen"]))
+
+        lines.append("# HELP sapphire_device_online Whether a device is online")
+        lines.append("# TYPE sapphire_device_online gauge")
+
+        for device_id, device in sorted(metrics["devices"].iteritems()):
+            lines.append('sapphire_device_online{device_id="%s"} %d' % \
+                        (device_id, device["status"] == "online"))
+
+        return "\n".join(lines) + "\n"
+
+    def run(self):
+        logging.info("MetricsServer listening on: %s:%d" % self._httpd.server_address)
+
+        self._httpd.serve_forever(poll_interval=1.0)
+
+        logging.info("MetricsServer stopped")
+
+    def stop(self):
+        logging.info("MetricsServer shutting down")
+
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -14,17 +14,36 @@ import threading
 import logging
 import socket
 import struct
+import multiprocessing
+from Queue import Queue, Full, Empty
 
-from sapphire.core import KVObjectsManager
-from sapphiredevices.devices.device import UnrecognizedKeyException
+from sapphiredevices.devices.device import UnrecognizedKeyException, ntp_to_datetime
+from sapphiredevices.devices.registry import device_registry
 
-from sapphiredevices.devices.udpx import ServerSocket
+from sapphiredevices.devices.udpx import ServerSocket, InvalidPacketException
 from sapphiredevices.devices.protocols import *
 from sapphiredevices.devices.fields import *
 
+from capture import CaptureWriter
+
 
 NOTIFICATION_SERVER_PORT = 59999
 
+# notifications are sharded across workers by device, so each device's
+# notifications are applied in order
+DEFAULT_WORKERS             = 4
+DEFAULT_QUEUE_SIZE          = 1024
+
+# the device ID follows the message type and flags
+DEVICE_ID_OFFSET            = 2
+DEVICE_ID_FORMAT            = struct.Struct('<Q')
+
+# log every Nth dropped notification while overloaded
+DROP_LOG_INTERVAL           = 1000
+
+# not defined by the socket module in python 2, this is the linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
 
 class NotificationProtocol(Protocol):
     class Notification0(Payload):
@@ -40,19 +59,206 @@ class NotificationProtocol(Protocol):
     msg_type_format = Uint8Field()
 
 
+def decode_notification(data):
+    # returns a tuple of plain values, so it can be passed between processes:
+    # (device_id, group, id, data_type, value, ntp seconds, ntp fraction)
+    msg = NotificationProtocol().unpack(data)
+
+    if not isinstance(msg, NotificationProtocol.Notification0):
+        raise ValueError("Unknown message: %s" % (type(msg).__name__))
+
+    value = sapphiretypes.getType(msg.data_type).unpack(msg.data).value
+
+    return (msg.device_id, 
+            msg.group, 
+            msg.id, 
+            msg.data_type, 
+            value, 
+            msg.timestamp.seconds, 
+            msg.timestamp.fraction)
+
+
+def _increment(counter):
+    with counter.get_lock():
+        counter.value += 1
+
+
+# runs in each intake process in multi-process mode.  the kernel spreads
+# senders across the processes bound to the port.  notifications are
+# decoded here and passed to the server process, which owns the devices.
+def _intake_process(port, out_queue, stop_event, counters, capture=None):
+    sock = ServerSocket()
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.settimeout(1.0)
+
+    if capture:
+        sock.capture = CaptureWriter(capture)
+
+    while not stop_event.is_set():
+        try:
+            data, host = sock.recvfrom()
+
+        except socket.timeout:
+            continue
+
+        except InvalidPacketException:
+            _increment(counters["invalid"])
+            continue
+
+        _increment(counters["received"])
+
+        try:
+            notification = decode_notification(data)
+
+        except Exception:
+            _increment(counters["invalid"])
+
+            # a retransmit won't decode any better
+            sock.sendto()
+            continue
+
+        try:
+            out_queue.put_nowait((notification, None, host))
+
+        except Full:
+            # don't ack, the device will retransmit after backing off
+            _increment(counters["dropped"])
+            continue
+
+        sock.sendto()
+
+    if sock.capture:
+        sock.capture.close()
+
+    sock.close()
+
+
 class NotificationServer(threading.Thread):
-    def __init__(self):
+    def __init__(self, 
+                 workers=DEFAULT_WORKERS, 
+                 queue_size=DEFAULT_QUEUE_SIZE, 
+                 processes=1,
+                 capture=None,
+                 journal=None):
+
         super(NotificationServer, self).__init__()
-                
-        self.sock = ServerSocket()
-        self.sock.bind(('0.0.0.0', NOTIFICATION_SERVER_PORT))
-        self.sock.settimeout(1.0)
+        
+        self.processes = processes
+
+        # filename to capture received datagrams to.  each intake process
+        # writes its own file, with its index appended.
+        self.capture = capture
+
+        # applied notifications are appended to the journal, if set
+        self.journal = journal
         
         self.running = True
 
+        self.stats = {"received":   0,
+                      "dropped":    0,
+                      "invalid":    0,
+                      "applied":    0,
+                      "not_found":  0,
+                      "errors":     0,
+                      "high_water": 0}
+
+        self._stats_lock = threading.Lock()
+
+        self._queues = [Queue(queue_size) for i in xrange(workers)]
+        self._workers = [threading.Thread(target=self._worker, args=(q,)) for q in self._queues]
+
+        if processes > 1:
+            self.sock = None
+
+            self._intake_queue = multiprocessing.Queue(queue_size)
+            self._intake_stop = multiprocessing.Event()
+            self._intake_counters = dict([(name, multiprocessing.Value('L', 0)) 
+                                            for name in ["received", "dropped", "invalid"]])
+
+            self._intake_processes = [multiprocessing.Process(target=_intake_process,
+                                                              args=(NOTIFICATION_SERVER_PORT,
+                                                                    self._intake_queue,
+                                                                    self._intake_stop,
+                                                                    self._intake_counters,
+                                                                    capture and "%s.%d" % (capture, i)))
+                                        for i in xrange(processes)]
+
+            for p in self._intake_processes:
+                p.daemon = True
+                p.start()
+
+        else:
+            self.sock = ServerSocket()
+            self.sock.bind(('0.0.0.0', NOTIFICATION_SERVER_PORT))
+            self.sock.settimeout(1.0)
+
+            if capture:
+                self.sock.capture = CaptureWriter(capture)
+
+        for w in self._workers:
+            w.start()
+
         self.start()
-    
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+
+        if self.processes > 1:
+            for name, counter in self._intake_counters.iteritems():
+                stats[name] += counter.value
+
+        stats["queue_depths"] = [q.qsize() for q in self._queues]
+        stats["queued"] = sum(stats["queue_depths"])
+
+        return stats
+
+    def _enqueue(self, device_id, item, block=False):
+        q = self._queues[device_id % len(self._queues)]
+
+        try:
+            q.put(item, block)
+
+        except Full:
+            # don't ack, the device will retransmit after backing off
+            self._count("dropped")
+
+            if self.stats["dropped"] % DROP_LOG_INTERVAL == 1:
+                logging.warn("NotificationServer overloaded, %d notifications dropped" % \
+                            (self.stats["dropped"]))
+
+            return False
+
+        depth = q.qsize()
+
+        if depth > self.stats["high_water"]:
+            self.stats["high_water"] = depth
+
+        return True
+
     def run(self):
+        if self.processes > 1:
+            self._run_processes()
+
+        else:
+            self._run_socket()
+
+        for q in self._queues:
+            q.put(None)
+
+        for w in self._workers:
+            w.join()
+        
+        logging.info("NotificationServer stopped")
+
+    # the intake thread only receives, queues and acks, so a slow
+    # subscriber can't stall the socket
+    def _run_socket(self):
         logging.info("NotificationServer listening on: %s:%d" % \
                     (self.sock.getsockname()[0], self.sock.getsockname()[1]))
 
@@ -60,42 +266,122 @@ class NotificationServer(threading.Thread):
             try:
                 # wait for messages
                 data, host = self.sock.recvfrom()
-                
-                # send empty response to initiate ack packet
-                self.sock.sendto()
 
-                msg = NotificationProtocol().unpack(data)
+            except socket.timeout:
+                continue
 
-                if isinstance(msg, NotificationProtocol.Notification0):
-                    
-                    # query for device
-                    try:
-                        msg.data = sapphiretypes.getType(msg.data_type).unpack(msg.data)
+            except InvalidPacketException:
+                self._count("invalid")
+                continue
 
-                        # query for device
-                        device = KVObjectsManager.query(device_id=msg.device_id)[0]
-                        
-                        # send notification msg to device
-                        device.receive_notification(msg)
+            self._count("received")
 
-                    except IndexError:
-                        logging.info("(notifications) Device: %d not found" % (msg.device_id))
+            if len(data) < DEVICE_ID_OFFSET + DEVICE_ID_FORMAT.size:
+                self._count("invalid")
+                continue
 
-                    except UnrecognizedKeyException as e:
-                        logging.info("UnrecognizedKeyException: %s" % (str(e)))
+            device_id = DEVICE_ID_FORMAT.unpack_from(data, DEVICE_ID_OFFSET)[0]
 
-                    except Exception as e:
-                        logging.error("Exception: %s Host: %s" % (str(e), host[0]))                                        
+            if not self._enqueue(device_id, (None, data, host)):
+                continue
 
-                else:
-                    logging.warn("Unknown message: %d from: %s" % (msg_type, str(host)))                    
+            # send empty response to initiate ack packet
+            self.sock.sendto()
 
+        if self.sock.capture:
+            self.sock.capture.close()
+
+        self.sock.close()
+
+    # the intake processes have already acked and decoded, the queues
+    # here apply backpressure to them instead of dropping
+    def _run_processes(self):
+        logging.info("NotificationServer listening on: 0.0.0.0:%d with %d processes" % \
+                    (NOTIFICATION_SERVER_PORT, self.processes))
+
+        while self.running:
+            try:
+                item = self._intake_queue.get(timeout=1.0)
+
+            except Empty:
+                continue
+
+            self._enqueue(item[0][0], item, block=True)
+
+        self._intake_stop.set()
+
+        # keep draining while the processes exit, they can't finish while
+        # their queue feeders are blocked
+        while len([p for p in self._intake_processes if p.is_alive()]) > 0:
+            try:
+                item = self._intake_queue.get(timeout=0.1)
+
+            except Empty:
+                continue
+
+            self._enqueue(item[0][0], item, block=True)
+
+        while True:
+            try:
+                item = self._intake_queue.get_nowait()
+
+            except Empty:
+                break
+
+            self._enqueue(item[0][0], item, block=True)
+
+        for p in self._intake_processes:
+            p.join()
+
+    def _worker(self, q):
+        while True:
+            item = q.get()
+
+            if item is None:
+                return
+
+            notification, data, host = item
+
+            if notification is None:
+                try:
+                    notification = decode_notification(data)
+
+                except Exception as e:
+                    self._count("invalid")
+                    logging.warn("Invalid notification: %s from: %s" % (str(e), str(host)))
+
+                    continue
+
+            self._apply(notification, host)
+
+    def _apply(self, notification, host):
+        device_id, group, id, data_type, value, seconds, fraction = notification
+
+        # query for device
+        device = device_registry.get(device_id)
+
+        if device is None:
+            self._count("not_found")
+            logging.info("(notifications) Device: %d not found" % (device_id))
+
+            return
+
+        try:
+            key = device.apply_notification(group, id, data_type, value, ntp_to_datetime(seconds, fraction))
+
+            self._count("applied")
+
+            if key is not None and self.journal is not None:
+                self.journal.append(notification, key)
+
+        except UnrecognizedKeyException as e:
+            self._count("errors")
+            logging.info("UnrecognizedKeyException: %s" % (str(e)))
+
+        except Exception as e:
+            self._count("errors")
+            logging.error("Exception: %s Host: %s" % (str(e), host[0]))                                        
 
-            except socket.timeout:
-                pass
-        
-        logging.info("NotificationServer stopped")
-        
     def stop(self):
         logging.info("NoticationServer shutting down")
         self.running = False
@@ -0,0 +1,390 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+"""Telemetry recorder
+
+Samples KV values (sys_stats by default) from online devices on a schedule,
+and records the values pushed by notifications in between.
+
+Samples are kept in one file per device per day.  A file is a sequence of
+blocks, each holding the samples of one key: a header with the key, sample
+count and time range, then the timestamp column and the value column, both
+delta encoded as zigzag varints.  Counters and gauges change slowly, so
+most samples take 2-4 bytes.
+
+Range queries only open the files for the days in the range, and skip
+blocks for other keys or outside the range by their header.
+"""
+
+import os
+import struct
+import threading
+import time
+import logging
+import calendar
+from datetime import datetime, timedelta
+
+from pydispatch import dispatcher
+
+from sapphiredevices.devices.device import KV_GROUP_SYS_STATS, SIGNAL_KV_UPDATED
+from sapphiredevices.devices.device import DeviceUnreachableException
+from sapphiredevices.devices.netscan import SIGNAL_FOUND_DEVICE
+from sapphiredevices.devices.group import DeviceGroup
+from sapphiredevices.devices.registry import device_registry
+
+
+DEFAULT_SAMPLE_INTERVAL     = 60.0
+DEFAULT_FLUSH_INTERVAL      = 600.0
+
+# samples buffered per key before a block is written
+BLOCK_SAMPLES               = 1024
+
+FILE_EXT                    = ".tsc"
+
+# key length, sample count, data length, first and last timestamp (ms)
+BLOCK_HEADER = struct.Struct('<BHIqq')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_ms(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+
+def from_ms(ms):
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def encode_varints(values, buf):
+    # zigzag varints, appended to a bytearray.  python ints have no fixed
+    # width, so the sign is folded in without assuming 64 bits.
+    for v in values:
+        if v >= 0:
+            v = v << 1
+
+        else:
+            v = ~(v << 1)
+
+        while v > 0x7f:
+            buf.append((v & 0x7f) | 0x80)
+            v >>= 7
+
+        buf.append(v)
+
+def decode_varints(buf, count):
+    values = list()
+    v = 0
+    shift = 0
+
+    for b in buf:
+        v |= (b & 0x7f) << shift
+        shift += 7
+
+        if b < 0x80:
+            values.append((v >> 1) ^ -(v & 1))
+            v = 0
+            shift = 0
+
+            if len(values) == count:
+                break
+
+    return values
+
+def delta_encode(values):
+    prev = 0
+    deltas = list()
+
+    for v in values:
+        deltas.append(v - prev)
+        prev = v
+
+    return deltas
+
+def delta_decode(deltas):
+    total = 0
+    values = list()
+
+    for d in deltas:
+        total += d
+        values.append(total)
+
+    return values
+
+
+def pack_block(key, samples):
+    # samples is a list of (ms, value)
+    data = bytearray()
+    encode_varints(delta_encode([s[0] for s in samples]), data)
+    encode_varints(delta_encode([s[1] for s in samples]), data)
+
+    header = BLOCK_HEADER.pack(len(key),
+                               len(samples),
+                               len(data),
+                               min(s[0] for s in samples),
+                               max(s[0] for s in samples))
+
+    return header + key + str(data)
+
+def unpack_block(count, data):
+    # decode both columns in one pass, the timestamps are first
+    deltas = decode_varints(bytearray(data), count * 2)
+
+    return zip(delta_decode(deltas[:count]), delta_decode(deltas[count:]))
+
+
+class TelemetryStore(object):
+    def __init__(self, path, block_samples=BLOCK_SAMPLES):
+        self.path = path
+        self.block_samples = block_samples
+
+        # (device_id, key) -> list of (ms, value) not yet written
+        self._buffers = dict()
+
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _device_dir(self, device_id):
+        return os.path.join(self.path, str(device_id))
+
+    def _day_file(self, device_id, day):
+        return os.path.join(self._device_dir(device_id), day.strftime("%Y%m%d") + FILE_EXT)
+
+    def append(self, device_id, key, value, timestamp=None):
+        # only integer values are recorded
+        if not isinstance(value, (int, long)):
+            return
+
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+
+        with self._lock:
+            buf = self._buffers.setdefault((device_id, key), list())
+            buf.append((to_ms(timestamp), int(value)))
+
+            if len(buf) < self.block_samples:
+                return
+
+            del self._buffers[(device_id, key)]
+
+        self._write(device_id, key, buf)
+
+    def _write(self, device_id, key, samples):
+        # split samples by day
+        days = dict()
+
+        for s in samples:
+            days.setdefault(from_ms(s[0]).date(), list()).append(s)
+
+        with self._file_lock:
+            if not os.path.exists(self._device_dir(device_id)):
+                os.makedirs(self._device_dir(device_id))
+
+            for day, day_samples in days.iteritems():
+                with open(self._day_file(device_id, day), 'ab') as f:
+                    f.write(pack_block(key, day_samples))
+
+    def flush(self):
+        with self._lock:
+            buffers = self._buffers
+            self._buffers = dict()
+
+        for (device_id, key), samples in buffers.iteritems():
+            self._write(device_id, key, samples)
+
+    def _read_blocks(self, filename, key, start_ms, end_ms):
+        samples = list()
+
+        with open(filename, 'rb') as f:
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+
+                if len(header) < BLOCK_HEADER.size:
+                    break
+
+                key_len, count, data_len, first, last = BLOCK_HEADER.unpack(header)
+
+                block_key = f.read(key_len)
+
+                if block_key != key or last < start_ms or first > end_ms:
+                    f.seek(data_len, os.SEEK_CUR)
+                    continue
+
+                data = f.read(data_len)
+
+                # truncated by a crash while writing
+                if len(data) < data_len:
+                    break
+
+                samples.extend(unpack_block(count, data))
+
+        return samples
+
+    def query(self, device_id, key, start=None, end=None):
+        # returns a list of (timestamp, value) in time order
+        if end is None:
+            end = datetime.utcnow()
+
+        if start is None:
+            start = end - timedelta(days=1)
+
+        start_ms = to_ms(start)
+        end_ms = to_ms(end)
+
+        samples = list()
+
+        day = start.date()
+
+        while day <= end.date():
+            filename = self._day_file(device_id, day)
+
+            if os.path.exists(filename):
+                samples.extend(self._read_blocks(filename, key, start_ms, end_ms))
+
+            day += timedelta(days=1)
+
+        # include samples which have not been written yet
+        with self._lock:
+            samples.extend(self._buffers.get((device_id, key), []))
+
+        samples = [s for s in samples if start_ms <= s[0] <= end_ms]
+        samples.sort()
+
+        return [(from_ms(s[0]), s[1]) for s in samples]
+
+    def devices(self):
+        return [int(d) for d in os.listdir(self.path) if d.isdigit()]
+
+    def expire(self, days):
+        # remove files more than the given number of days old
+        cutoff = (datetime.utcnow() - timedelta(days=days)).strftime("%Y%m%d")
+
+        with self._file_lock:
+            for device_id in self.devices():
+                for filename in os.listdir(self._device_dir(device_id)):
+                    if filename.endswith(FILE_EXT) and filename[:-len(FILE_EXT)] < cutoff:
+                        os.remove(os.path.join(self._device_dir(device_id), filename))
+
+
+class TelemetryRecorder(threading.Thread):
+    def __init__(self,
+                 store,
+                 keys=None,
+                 interval=DEFAULT_SAMPLE_INTERVAL,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 retention_days=None):
+
+        super(TelemetryRecorder, self).__init__()
+
+        self.store = store
+
+        # keys to record, None records the whole sys_stats group
+        self.keys = keys
+        self._key_set = set(keys) if keys is not None else None
+
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+
+        self._devices = dict()
+        self._lock = threading.Lock()
+
+        self._stop_event = threading.Event()
+
+        dispatcher.connect(self._found_device, signal=SIGNAL_FOUND_DEVICE)
+        dispatcher.connect(self._kv_updated, signal=SIGNAL_KV_UPDATED)
+
+        # devices found before the recorder started are only signalled once
+        for device in device_registry.devices():
+            self._found_device(device)
+
+        self.start()
+
+    def _found_device(self, device):
+        with self._lock:
+            self._devices[device.device_id] = device
+
+    def _recorded_keys(self, device):
+        if self.keys is not None:
+            return [k for k in self.keys if k in device._keys]
+
+        return [k for k in device._keys if device._keys[k].group == KV_GROUP_SYS_STATS]
+
+    def _kv_updated(self, device, key, value, timestamp):
+        # runs for every notification, so only the one key is checked
+        if self._key_set is not None:
+            recorded = key in self._key_set
+
+        else:
+            try:
+                recorded = device._keys[key].group == KV_GROUP_SYS_STATS
+
+            except KeyError:
+                recorded = False
+
+        if recorded:
+            self.store.append(device.device_id, key, value, timestamp)
+
+    def _sample(self, device):
+        keys = self._recorded_keys(device)
+
+        if len(keys) == 0:
+            return
+
+        timestamp = datetime.utcnow()
+
+        for key, value in device.getKV(*keys).iteritems():
+            self.store.append(device.device_id, key, value, timestamp)
+
+    def sample(self):
+        with self._lock:
+            devices = [d for d in self._devices.itervalues() if d.device_status == "online"]
+
+        for device, result, error in DeviceGroup(devices, pipelined=True).imap(self._sample):
+            if isinstance(error, DeviceUnreachableException):
+                logging.info("Recorder: device %d unreachable" % (device.device_id))
+
+            elif error is not None:
+                logging.error("Recorder: device %d: %s" % (device.device_id, error))
+
+    def run(self):
+        logging.info("TelemetryRecorder running")
+
+        next_flush = time.time() + self.flush_interval
+
+        while not self._stop_event.is_set():
+            start = time.time()
+
+            self.sample()
+
+            if time.time() >= next_flush:
+                self.store.flush()
+
+                if self.retention_days is not None:
+                    self.store.expire(self.retention_days)
+
+                next_flush = time.time() + self.flush_interval
+
+            self._stop_event.wait(max(self.interval - (time.time() - start), 0))
+
+        self.store.flush()
+
+        logging.info("TelemetryRecorder stopped")
+
+    def stop(self):
+        logging.info("TelemetryRecorder shutting down")
+
+        dispatcher.disconnect(self._found_device, signal=SIGNAL_FOUND_DEVICE)
+        dispatcher.disconnect(self._kv_updated, signal=SIGNAL_KV_UPDATED)
+
+        self._stop_event.set()
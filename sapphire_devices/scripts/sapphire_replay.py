@@ -0,0 +1,18 @@
+#! python
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+from sapphiredevices.deviceserver.capture import main
+
+if __name__ == "__main__":
+    main()
+
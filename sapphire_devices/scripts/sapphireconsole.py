@@ -11,14 +11,16 @@
 # </license>
 #
 
-import threading
-
 from sapphire.core import KVObjectsManager
-from sapphiredevices.devices import Device, DeviceUnreachableException
+from sapphiredevices.devices import Device, DeviceUnreachableException, DeviceGroup
 from sapphiredevices.devices import netscan
+from sapphiredevices.devices import rollout
+from sapphiredevices.devices import diagnostics
+from sapphiredevices.devices.device import CLI_PREFIX
 
 import traceback
 import sys
+import time
 
 import cmd2 as cmd
 
@@ -43,11 +45,25 @@ def make_query_dict(line):
     
     return d
 
+# commands which prompt for input or write to the terminal or local files
+# while they run, these are always run one target at a time
+SERIAL_COMMANDS = set(['resetcfg', 'getfile', 'putfile', 'loadfw'])
+
+# number of slowest targets listed in the command summary
+SLOWEST_COUNT = 3
+
 class SapphireConsole(cmd.Cmd):
    
     prompt = '(Nothing): '
     
     ruler = '-'
+
+    # number of targets a command runs on at once, also when they are all
+    # behind the same gateway
+    parallel = 16
+
+    # print command output in target order, or stream it as targets finish
+    ordered = True
     
     def __init__(self, targets=[]):
         self.targets = targets
@@ -148,14 +164,47 @@ class SapphireConsole(cmd.Cmd):
         for target in self.targets:
             print target.who()
 
+    def do_parallel(self, line):
+        if line != "":
+            SapphireConsole.parallel = max(int(line), 1)
 
-cli_template = """
-    def do_$fname(self, line):
+        print "Running commands on %d targets at once" % (self.parallel)
+
+    def do_output(self, line):
+        if line == "ordered":
+            SapphireConsole.ordered = True
+
+        elif line == "stream":
+            SapphireConsole.ordered = False
+
+        elif line != "":
+            print "Usage: output [ordered|stream]"
+            return
+
+        if self.ordered:
+            print "Output is printed in target order"
+
+        else:
+            print "Output is printed as targets finish"
+
+    def _print_result(self, r):
+        s = '%s@%5d: ' % (r.device.name.ljust(24), r.device.short_addr)
+
+        if r.error is None:
+            print s + str(r.result)
+
+        else:
+            print s + 'Error:%s from %s' % (r.error, r.device.host)
+
+            if not isinstance(r.error, DeviceUnreachableException):
+                sys.stdout.write(r.traceback)
+
+    def run_serial(self, fname, line):
         for target in self.targets:
             sys.stdout.write('%s@%5d: ' % (target.name.ljust(24), target.short_addr))
 
             try:
-                print target.cli_$fname(line)
+                print getattr(target, CLI_PREFIX + fname)(line)
             
             except DeviceUnreachableException as e:
                 print 'Error:%s from %s' % (e, target.host) 
@@ -164,6 +213,88 @@ cli_template = """
                 print 'Error:%s from %s' % (e, target.host) 
                 traceback.print_exc()
 
+    def run_parallel(self, fname, line):
+        start = time.time()
+
+        group = DeviceGroup(self.targets, max_workers=self.parallel, per_gateway=self.parallel)
+
+        results = list()
+
+        for r in group.imap(CLI_PREFIX + fname, line):
+            results.append(r)
+
+            if not self.ordered:
+                self._print_result(r)
+
+        if self.ordered:
+            position = dict([(id(t), i) for i, t in enumerate(self.targets)])
+
+            for r in sorted(results, key=lambda r: position[id(r.device)]):
+                self._print_result(r)
+
+        # summary
+        if len(results) > 1:
+            failed = [r for r in results if r.error is not None]
+            slowest = sorted(results, key=lambda r: r.elapsed, reverse=True)[:SLOWEST_COUNT]
+
+            print "%d targets, %d failed in %.2f sec. Slowest: %s" % \
+                (len(results),
+                 len(failed),
+                 time.time() - start,
+                 ', '.join(["%s (%d ms)" % (r.device.name, r.elapsed * 1000) for r in slowest]))
+
+    def do_diag(self, line):
+        if line == "":
+            print "Usage: diag <file.json|file.csv>"
+            return
+
+        start = time.time()
+
+        snapshots, errors = diagnostics.collect_fleet(self.targets,
+                                                      max_workers=self.parallel,
+                                                      per_gateway=self.parallel)
+
+        for device_id, error in errors.iteritems():
+            print "Error:%s from %d" % (error, device_id)
+
+        diagnostics.export(snapshots, line)
+
+        print "Collected %d devices (%d failed) in %.2f sec to %s" % \
+            (len(snapshots), len(errors), time.time() - start, line)
+
+    def do_rollout(self, line):
+        if line == "":
+            print "Usage: rollout <firmware_id>"
+            return
+
+        def progress(status):
+            if status.state in ['done', 'failed']:
+                print status
+
+        try:
+            summary = rollout.rollout(self.targets, line, progress=progress)
+
+        except rollout.RolloutAbortedException as e:
+            print "Rollout aborted: %s" % (e)
+            return
+
+        print "Loaded %d of %d devices (%d failed, %d retries) in %.1f sec, %d bytes/sec" % \
+            (summary["done"],
+             summary["devices"],
+             summary["failed"],
+             summary["retries"],
+             summary["elapsed"],
+             summary["bytes_per_sec"])
+
+
+cli_template = """
+    def do_$fname(self, line):
+        if '$fname' in SERIAL_COMMANDS:
+            self.run_serial('$fname', line)
+
+        else:
+            self.run_parallel('$fname', line)
+
 """
 
 def makeConsole(targets=[], device=None):
@@ -217,29 +348,18 @@ if __name__ == '__main__':
             print "Found: %d" % (d.device_id)        
 
 
-        threads = list()
-
-        for device in all_devices:
-            def scan_func(d):            
-                print "Scanning: %d" % (d.device_id)
+        print "Scanning %d devices..." % (len(all_devices))
 
-                try:
-                    d.scan()
-                    
-                    print "Done: %d" % (d.device_id)
+        for d, result, error in DeviceGroup(all_devices).imap('scan'):
+            if isinstance(error, DeviceUnreachableException):
+                print "!!! Device %d unreachable" % (d.device_id)
 
-                except DeviceUnreachableException:
-                    print "!!! Device %d unreachable" % (d.device_id)
+            elif error is not None:
+                print "!!! Device %d error: %s" % (d.device_id, error)
 
-            t = threading.Thread(target=scan_func, args=[device])
-            t.start()
+            else:
+                print "Done: %d" % (d.device_id)
 
-            threads.append(t)
-
-        for t in threads:
-            t.join()
-
-        
 
         c = SapphireConsole()
 
@@ -17,7 +17,8 @@ setup(
     scripts=['scripts/sapphireconsole.py',
              'scripts/sapphiremake.py',
              'scripts/sapphire_deviceserver.py',
-             'scripts/sapphire_devicesetup.py'],
+             'scripts/sapphire_devicesetup.py',
+             'scripts/sapphire_replay.py'],
 
     license='License :: OSI Approved :: Mozilla Public License 2.0 (MPL 2.0)',
 